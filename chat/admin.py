@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import Order, Chat, Message
+from .models import Order, Chat, Message, ReadState, Job
 
 
 admin.site.register(Order)
 admin.site.register(Chat)
 admin.site.register(Message)
+admin.site.register(ReadState)
+admin.site.register(Job)
@@ -0,0 +1,83 @@
+import hashlib
+
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.utils import timezone
+
+
+# Version stamps live in the shared cache so every worker agrees on them.
+# A stamp is the time of the last change to the resource; a missing stamp
+# is (re)initialised to "now", which can only cause a spurious 200. They only
+# go into ETags: as Last-Modified they would be cut to whole seconds, and
+# come from each node's own clock, so a change within the same second as a
+# client's last fetch would be answered 304.
+VERSION_TIMEOUT = None
+
+
+def version_key(*parts):
+    return "version-%s" % "-".join(str(p) for p in parts)
+
+
+def get_version(*parts):
+    return cache.get_or_set(version_key(*parts), timezone.now, VERSION_TIMEOUT)
+
+
+def bump_version(*parts):
+    # Once the change is committed, a read before that would otherwise get the
+    # new version along with the old rows and be answered 304 until the next change
+    transaction.on_commit(lambda: cache.set(version_key(*parts), timezone.now(), VERSION_TIMEOUT))
+
+
+def listing_etag(request, version):
+    """
+    ETag for a listing: the resource version, who is asking and with which
+    filters, since querysets can depend on the latter two.
+    """
+    raw = "%s|%s|%s" % (version.isoformat(), request.user.pk, request.GET.urlencode())
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+# Rows that rarely change are read through a two-level cache, see CACHES.
+
+
+def chat_key(pk):
+    return "chat-%s" % pk
+
+
+def order_key(pk):
+    return "order-%s" % pk
+
+
+def get_cached(key, loader):
+    local_cache = caches['local']
+    value = local_cache.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is None:
+            value = loader()
+            cache.set(key, value)
+        local_cache.set(key, value)
+    return value
+
+
+async def aget_cached(key, loader):
+    # The local cache is an in-process dict, its aget/aset would only queue up
+    # behind the ORM in the sync thread
+    local_cache = caches['local']
+    value = local_cache.get(key)
+    if value is None:
+        value = await cache.aget(key)
+        if value is None:
+            value = await loader()
+            await cache.aset(key, value)
+        local_cache.set(key, value)
+    return value
+
+
+def invalidate(*keys):
+    # Once the change is committed, a read before that would put the old row
+    # back for the whole TIMEOUT
+    def delete():
+        caches['local'].delete_many(keys)
+        cache.delete_many(keys)
+    transaction.on_commit(delete)
@@ -1,17 +1,16 @@
 import logging
+from urllib.parse import parse_qs
 
 from django.conf import settings
 
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.contrib.auth import get_user_model
 from django.utils import timezone
 
+from . import jobs, ratelimit, receipts, trace, workers
 from .exceptions import ClientError
-from .models import Message, MessageTypes
+from .models import Message, MessageTypes, ReadState
 from .utils import get_chat_or_error
 
-User = get_user_model()
-
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     """
     This chat consumer handles websocket connections for chat clients.
@@ -28,31 +27,46 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         """
         Called when the websocket is handshaking as part of initial connection.
         """
-        # Are they logged in?
-        if not self.scope["user"].is_authenticated:
+        # Are they logged in, and is this worker still taking connections?
+        if not self.scope["user"].is_authenticated or workers.draining:
             # Reject the connection
             await self.close()
-        else:
-            # Accept the connection
-            await self.accept()
-        # Store which chats the user has joined on this connection
-        self.chats = set()
-        await self.join_chat(int(self.scope['url_route']['kwargs']['pk']))
+            return
+        # Accept the connection
+        await self.accept()
+        workers.accepted(self)
+        # Store which chats the user has joined on this connection, with the
+        # last message delivered in each, which is where a reconnect resumes
+        self.chats = {}
+        chat_id = int(self.scope['url_route']['kwargs']['pk'])
+        trace.record(
+            self.channel_name, "connect",
+            user=[self.scope["user"].id, self.scope["user"].username], chat=chat_id,
+        )
+        # Clients told to reconnect by drain come back with ?after=<message id>
+        after = parse_qs(self.scope["query_string"].decode()).get("after", ["0"])[0]
+        await self.join_chat(chat_id, int(after) if after.isdigit() else 0)
 
     async def receive_json(self, content):
         """
         Called when we get a text frame. Channels will JSON-decode the payload
         for us and pass it as the first argument.
         """
+        trace.record(self.channel_name, "receive", content=content)
         # Messages will have a "command" key we can switch on
         command = content.get("command", None)
         try:
+            # Turn away floods before they reach the database or the channel layer
+            if not await ratelimit.allow(self.scope["user"].id, command):
+                raise ClientError("RATE_LIMITED")
             if command == "join":
-                await self.join_chat(content["chat"])
+                await self.join_chat(content["chat"], content.get("after", 0))
             elif command == "leave":
                 await self.leave_chat(content["chat"])
             elif command == "send":
                 await self.send_chat(content["chat"], content["message"])
+            elif command in ("ack", "read"):
+                await self.acknowledge(content["chat"], content["id"], read=command == "read")
             elif command == "typing":
                 await self.channel_layer.group_send(
                     f'chat-{content["chat"]}',
@@ -65,13 +79,15 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 )
             elif command == "ping":
                 now = timezone.now()
-                await User.objects.filter(id=self.scope['user'].id).aupdate(last_login=now)
+                # Written to the database in batches
+                jobs.touch_last_login(self.scope['user'].id, now)
                 await self.channel_layer.group_send(
                     f'chat-{content["chat"]}',
                     {
                         "type": "chat.ping",
                         "chat_id": content['chat'],
                         "username": self.scope['user'].username,
+                        "user_id": self.scope["user"].id,
                         "last_login": now.isoformat()
                     }
                 )
@@ -83,21 +99,42 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         """
         Called when the WebSocket closes for any reason.
         """
-        for chat_id in list(self.chats):
+        for chat_id in list(getattr(self, 'chats', ())):
             try:
                 await self.leave_chat(chat_id)
             except ClientError:
                 pass
+        workers.connections.discard(self)
+        if hasattr(self, 'chats'):
+            trace.record(self.channel_name, "disconnect")
+
+    async def drain(self):
+        """
+        Called when this worker shuts down: tells the client to reconnect
+        and which chats to resume after which message, then closes the socket.
+        """
+        await self.send_json({
+            "reconnect": True,
+            "chats": [{"chat": chat_id, "after": after} for chat_id, after in sorted(self.chats.items())],
+        })
+        # Servers may only send 1000 or 3000-4999, 4012 mirrors 1012 "Service Restart"
+        await self.close(code=4012)
 
-    async def join_chat(self, chat_id):
+    async def join_chat(self, chat_id, after=0):
         """
-        Called by receive_json when someone sent a join command.
+        Called by receive_json when someone sent a join command. Only the
+        history after message `after` is sent.
         """
+        if not isinstance(after, int) or after < 0:
+            raise ClientError("MESSAGE_INVALID")
         # The logged-in user is in our scope thanks to the authentication ASGI middleware
         chat = await get_chat_or_error(chat_id, self.scope["user"])
+        trace.record_chat(chat)
         await self.chat_info(chat)
-        async for message in chat.message_set.select_related('user', 'chat').all():
+        last = after
+        async for message in chat.message_set.filter(pk__gt=after).select_related('user', 'chat'):
             await self.send_json(message.to_json())
+            last = max(last, message.pk)
         await self.channel_layer.group_send(
             chat.group_name,
             {
@@ -108,16 +145,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             }
         )
         # Store that we're in the chat
-        self.chats.add(chat.id)
-        # Add them to the group so they get chat messages
+        self.chats[chat.id] = max(self.chats.get(chat.id, 0), last)
+        # Add them to the group so they get chat messages, order-wide messages
+        # are sent to each of the order's chats
         await self.channel_layer.group_add(
             chat.group_name,
             self.channel_name,
         )
-        await self.channel_layer.group_add(
-            chat.order.group_name,
-            self.channel_name,
-        )
         # Instruct their client to finish opening the chat
         await self.send_json({
             "join": chat.id,
@@ -137,19 +171,16 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 "type": "chat.leave",
                 "username": self.scope["user"].username,
                 "user_id": self.scope["user"].id,
+                "chat_id": chat_id,
             }
         )
         # Remove that we're in the chat
-        self.chats.discard(chat.id)
+        self.chats.pop(chat.id, None)
         # Remove them from the group so they no longer get chat messages
         await self.channel_layer.group_discard(
             chat.group_name,
             self.channel_name,
         )
-        await self.channel_layer.group_discard(
-            chat.order.group_name,
-            self.channel_name,
-        )
         # Instruct their client to finish closing the chat
         await self.send_json({
             "leave": str(chat.id),
@@ -166,11 +197,12 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         chat = await get_chat_or_error(chat_id, self.scope["user"])
         if not chat.is_writable(self.scope['user']):
             raise ClientError("CHAT_ACCESS_DENIED")
-        await Message.objects.acreate(chat=chat, user=self.scope["user"], message=message)
+        stored = await Message.objects.acreate(chat=chat, user_id=self.scope["user"].id, message=message)
         await self.channel_layer.group_send(
             chat.group_name,
             {
                 "type": "chat.message",
+                "id": stored.pk,
                 "chat_id": chat_id,
                 "username": self.scope["user"].username,
                 "user_id": self.scope['user'].id,
@@ -178,6 +210,18 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             }
         )
 
+    async def acknowledge(self, chat_id, message_id, read=False):
+        """
+        Called by receive_json when someone got ("ack") or read ("read") the
+        messages of a chat up to message_id.
+        """
+        if chat_id not in self.chats:
+            raise ClientError("CHAT_ACCESS_DENIED")
+        if not isinstance(message_id, int) or message_id < 0:
+            raise ClientError("MESSAGE_INVALID")
+        # Stored and sent to the chat in batches
+        receipts.acknowledge(chat_id, self.scope["user"].id, message_id, message_id if read else 0)
+
     ##### Handlers for messages sent over the channel layer
 
     # These helper methods are named by the types we send - so chat.join becomes chat_join
@@ -234,9 +278,11 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         """
         Called when someone has messaged our chat.
         """
+        self.delivered(event["chat_id"], event["id"])
         # Send a message down to the client
         await self.send_json(
             {
+                "id": event["id"],
                 "msg_type": MessageTypes.MESSAGE.value,
                 "chat": event["chat_id"],
                 "username": event["username"],
@@ -245,6 +291,33 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             },
         )
 
+    async def chat_notice(self, event):
+        """
+        Called when a message was stored outside of a websocket, like status
+        changes from background jobs (see Message.send).
+        """
+        event = dict(event)
+        del event["type"]
+        self.delivered(event["chat"], event["id"])
+        await self.send_json(event)
+
+    async def chat_receipt(self, event):
+        """
+        Called with the receipts of a chat that came in since the last ones.
+        """
+        await self.send_json(
+            {
+                "msg_type": MessageTypes.RECEIPT.value,
+                "chat": event["chat_id"],
+                "receipts": event["receipts"],
+            },
+        )
+
+    def delivered(self, chat_id, message_id):
+        # Where a reconnect resumes, see drain
+        if message_id > self.chats.get(chat_id, message_id):
+            self.chats[chat_id] = message_id
+
     async def chat_info(self, chat):
         await self.send_json(
             {
@@ -253,17 +326,9 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 "title": chat.order.title,
                 "timestamp": chat.timestamp.isoformat(),
                 "users": [
-                    {'username': u.username, 'user_id': u.id, 'last_login': u.last_login.isoformat()}
-                    for u in chat.users()]
+                    {'username': u.username, 'user_id': u.id, 'last_login': u.last_login and u.last_login.isoformat()}
+                    for u in chat.users()],
+                "receipts": [state.to_json() async for state in ReadState.objects.filter(chat=chat)],
             },
         )
 
-    async def order_message(self, order, message):
-        await self.channel_layer.group_send(
-            order.group_name,
-            {
-                "msg_type": MessageTypes.STATUS.value,
-                "type": "chat.message",
-                "message": message,
-            }
-        )
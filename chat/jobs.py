@@ -0,0 +1,213 @@
+"""
+Background jobs for side effects that shouldn't hold up a request, like
+telling every chat about an order status change.
+
+Jobs are stored in the Job table, then run by a thread pool in the process
+that enqueued them once the enqueueing transaction commits. Failed jobs are
+retried with exponential backoff. "manage.py runjobs" picks up whatever a
+process didn't get to (crashes, restarts) and reports throughput and latency.
+
+With CHAT_JOB_THREADS = 0 jobs run right after the commit in the enqueueing
+thread instead, which is what the in-memory channel layer needs.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, connections, IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import receipts
+from .models import Chat, Job, JobStatuses, Message, MessageTypes, Order, ReadState
+
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+registry = {}
+# The job each thread is running, for jobs that keep progress on it
+_local = threading.local()
+executor = settings.CHAT_JOB_THREADS and ThreadPoolExecutor(
+    max_workers=settings.CHAT_JOB_THREADS, thread_name_prefix="chat-jobs"
+)
+
+
+def job(func):
+    registry[func.__name__] = func
+    return func
+
+
+def enqueue(name, *args, key=None):
+    """
+    Stores a job and runs it once the current transaction commits. With a
+    key, a job that was already enqueued under it is returned instead.
+    """
+    if name not in registry:
+        raise ValueError("Unknown job %r" % name)
+    try:
+        with transaction.atomic():
+            instance = Job.objects.create(name=name, args=list(args), key=key)
+    except IntegrityError:
+        if key is None:
+            raise
+        return Job.objects.get(key=key)
+    if executor:
+        transaction.on_commit(lambda: executor.submit(run, instance.pk))
+    else:
+        transaction.on_commit(lambda: run(instance.pk))
+    return instance
+
+
+def run(pk):
+    """
+    Runs job `pk` if it is due and nobody else took it.
+    """
+    close_old_connections()
+    try:
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=pk, status=JobStatuses.PENDING, run_at__lte=now).update(
+            status=JobStatuses.RUNNING, started=now, attempts=F('attempts') + 1
+        )
+        if not claimed:
+            return
+        instance = Job.objects.get(pk=pk)
+        start = time.monotonic()
+        _local.job = instance
+        try:
+            registry[instance.name](*instance.args)
+        except Exception as e:
+            failed(instance, e)
+        else:
+            instance.status = JobStatuses.DONE
+            instance.finished = timezone.now()
+            instance.save(update_fields=['status', 'finished'])
+            logger.info(
+                "Job %s done in %.3fs, %.3fs after it was enqueued",
+                instance, time.monotonic() - start, (instance.started - instance.created).total_seconds(),
+            )
+    finally:
+        _local.job = None
+        close_old_connections()
+
+
+def send_messages(create):
+    """
+    Stores the messages returned by `create` and sends them to their chats.
+
+    The ids of the stored messages are saved on the running job in the same
+    transaction, and the ids not sent yet when sending fails, so a retry only
+    sends those instead of storing the messages again.
+    """
+    instance = _local.job
+    if instance.result is None:
+        with transaction.atomic():
+            instance.result = [message.pk for message in create()]
+            instance.save(update_fields=['result'])
+    pending = instance.result
+    messages = Message.objects.select_related('chat', 'user').in_bulk(pending)
+    for n, pk in enumerate(pending):
+        try:
+            if pk in messages:
+                messages[pk].send()
+        except Exception:
+            instance.result = pending[n:]
+            instance.save(update_fields=['result'])
+            raise
+
+
+def failed(instance, error):
+    instance.error = repr(error)
+    if instance.attempts >= settings.CHAT_JOB_MAX_ATTEMPTS:
+        logger.error("Job %s failed for good after %d attempts: %r", instance, instance.attempts, error)
+        instance.status = JobStatuses.FAILED
+        instance.finished = timezone.now()
+        instance.save(update_fields=['error', 'status', 'finished'])
+        return
+    delay = 2 ** instance.attempts
+    logger.warning("Job %s failed, retrying in %ss: %r", instance, delay, error)
+    instance.status = JobStatuses.PENDING
+    instance.run_at = timezone.now() + timedelta(seconds=delay)
+    instance.save(update_fields=['error', 'status', 'run_at'])
+    if executor:
+        timer = threading.Timer(delay, executor.submit, (run, instance.pk))
+        timer.daemon = True
+        timer.start()
+
+
+##### Jobs
+
+@job
+def order_status_changed(order_id, status):
+    order = Order.objects.get(pk=order_id)
+    send_messages(lambda: order.status_messages(status))
+
+
+@job
+def chat_message(chat_id, user_id, message):
+    chat = Chat.objects.get(pk=chat_id)
+    send_messages(lambda: [chat.add_message(msg_type=MessageTypes.STATUS, user_id=user_id, message=message)])
+
+
+@job
+def send_receipts(state_ids):
+    states = {}
+    for state in ReadState.objects.filter(pk__in=state_ids):
+        states.setdefault(state.chat_id, []).append(state)
+    for chat_id, chat_states in states.items():
+        async_to_sync(receipts.broadcast)(chat_id, chat_states)
+
+
+@job
+def update_last_logins(logins):
+    # One UPDATE per chunk of the batch, never moving a last_login backwards.
+    # Every user takes four query parameters, which SQLite limits.
+    logins = [(int(pk), parse_datetime(when)) for pk, when in logins.items()]
+    max_params = connections[User.objects.db].features.max_query_params
+    size = max_params // 5 if max_params else len(logins) or 1
+    for start in range(0, len(logins), size):
+        chunk = logins[start:start + size]
+        User.objects.filter(pk__in=[pk for pk, _ in chunk]).update(last_login=Case(
+            *(When(Q(last_login__isnull=True) | Q(last_login__lt=when), pk=pk, then=Value(when))
+              for pk, when in chunk),
+            default=F('last_login'),
+        ))
+
+
+##### last_login batching
+
+_last_logins = {}
+_last_logins_lock = threading.Lock()
+
+
+def touch_last_login(user_id, when):
+    """
+    Records that a user was active. Doesn't touch the database, the latest
+    time of every user is written in one job every CHAT_LAST_LOGIN_INTERVAL.
+    """
+    with _last_logins_lock:
+        first = not _last_logins
+        _last_logins[str(user_id)] = when.isoformat()
+    if first:
+        timer = threading.Timer(settings.CHAT_LAST_LOGIN_INTERVAL, flush_last_logins)
+        timer.daemon = True
+        timer.start()
+
+
+def flush_last_logins():
+    with _last_logins_lock:
+        logins = dict(_last_logins)
+        _last_logins.clear()
+    try:
+        if logins:
+            enqueue('update_last_logins', logins)
+    finally:
+        connections.close_all()
@@ -0,0 +1,36 @@
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping & Veach): maps a 64-bit key to one of
+    `buckets`, and growing from n to n+1 buckets only moves 1/(n+1) of keys.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+class ShardedChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer spread over several Redis instances.
+
+    Channels and groups (chat-<id>) are placed on a shard by a jump
+    consistent hash of their name instead of channels_redis' crc32 modulo,
+    so appending a host to the end of the list only moves about
+    1/len(hosts) of them. The host list is the routing table: every node has
+    to run with the same list in the same order, and changing it means
+    draining and restarting all nodes together so clients re-join their
+    groups on the new shards.
+    """
+
+    def consistent_hash(self, value):
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        key = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "big")
+        return jump_hash(key, self.ring_size)
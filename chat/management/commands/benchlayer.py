@@ -0,0 +1,84 @@
+import asyncio
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.layers import ShardedChannelLayer
+from chat.testing import redis_servers
+
+
+def broadcast(hosts, index, groups, messages, concurrency, barrier, results):
+    """
+    One process standing in for a worker: `groups` chats with one member
+    each, `messages` group sends spread over them, received by the members.
+    """
+    results.put(asyncio.run(abroadcast(hosts, index, groups, messages, concurrency, barrier)))
+
+
+async def abroadcast(hosts, index, groups, messages, concurrency, barrier):
+    layer = ShardedChannelLayer(hosts=hosts, capacity=messages + 1, expiry=600)
+    names = ["chat-%d-%d" % (index, n) for n in range(groups)]
+    channels = {}
+    for name in names:
+        channels[name] = await layer.new_channel()
+        await layer.group_add(name, channels[name])
+    expected = {name: messages // groups + (n < messages % groups) for n, name in enumerate(names)}
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    start = time.monotonic()
+
+    async def send(offset):
+        for n in range(offset, messages, concurrency):
+            await layer.group_send(names[n % groups], {"type": "chat.notice", "n": n})
+
+    async def receive(name):
+        for _ in range(expected[name]):
+            await layer.receive(channels[name])
+
+    await asyncio.gather(
+        *(send(offset) for offset in range(concurrency)),
+        *(receive(name) for name in names if expected[name]),
+    )
+    elapsed = time.monotonic() - start
+    await layer.close_pools()
+    return elapsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures broadcast throughput of the sharded channel layer with 1, 2, 4... Redis "
+        "servers started locally for the run (needs redis-server on PATH). Several processes "
+        "send to chat groups and receive the messages, like workers do."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="Redis server counts to compare")
+        parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="Sending and receiving processes")
+        parser.add_argument("--groups", type=int, default=100, help="Chat groups per process")
+        parser.add_argument("--messages", type=int, default=10000, help="Messages sent per process")
+        parser.add_argument("--concurrency", type=int, default=20, help="Concurrent sends per process")
+
+    def handle(self, *args, **options):
+        baseline = None
+        for shards in options["shards"]:
+            with redis_servers(shards) as hosts:
+                rate = self.run(hosts, options)
+            baseline = baseline or rate
+            self.stdout.write("%d shards: %.0f messages/s (x%.2f)" % (shards, rate, rate / baseline))
+
+    def run(self, hosts, options):
+        processes = options["processes"]
+        barrier = multiprocessing.Barrier(processes)
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=broadcast, args=(
+                hosts, index, options["groups"], options["messages"], options["concurrency"], barrier, results,
+            ))
+            for index in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        elapsed = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        return processes * options["messages"] / max(elapsed)
@@ -0,0 +1,113 @@
+import asyncio
+import gc
+import tracemalloc
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from channels.testing import WebsocketCommunicator
+
+from chat.models import Chat, Order
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures memory per idle websocket connection. Opens connections through the full "
+        "ASGI stack, each joined to its own chat, on a test database and the configured channel "
+        "layer under a separate prefix, and reports the bytes traced per connection. Tracing about "
+        "doubles the process size, 100000 connections need some 6GB."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, nargs="+", default=[10000, 100000], help="Connection counts to measure")
+        parser.add_argument(
+            "--in-memory", action="store_true",
+            help="Use the in-memory channel layer instead, it scans all channels on every message so keep counts small",
+        )
+
+    def handle(self, *args, **options):
+        if options["in_memory"]:
+            layer = {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+        else:
+            # Keep the benchmark's groups apart from the live ones. redis-py's
+            # default 5s socket timeout races the layer's 5s blocking pop once
+            # the loop is busy with thousands of connections, so drop it.
+            layer = dict(settings.CHANNEL_LAYERS["default"])
+            config = dict(layer.get("CONFIG", {}), prefix="benchmemory")
+            config["hosts"] = [
+                {"host": host[0], "port": host[1], "socket_timeout": None} if isinstance(host, (tuple, list)) else host
+                for host in config.get("hosts") or [("localhost", 6379)]
+            ]
+            layer["CONFIG"] = config
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(
+                CHANNEL_LAYERS={"default": layer},
+                CACHES={
+                    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "memory"},
+                    "local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "memory-local", "TIMEOUT": 2},
+                },
+                CHAT_RATE_LIMITS={},
+            ):
+                chats, session_key = self.create_fixtures(max(options["connections"]) + 1)
+                for count in options["connections"]:
+                    per_connection = asyncio.run(self.measure(count, chats, session_key))
+                    self.stdout.write("%d connections: %d bytes per connection" % (count, per_connection))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def create_fixtures(self, count):
+        user = User.objects.create_user("memory-benchmark", last_login=timezone.now())
+        orders = Order.objects.bulk_create([Order(user=user, title="memory benchmark") for _ in range(count)])
+        chats = Chat.objects.bulk_create([Chat(order=order, candidate=user) for order in orders])
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return [chat.pk for chat in chats], session.session_key
+
+    async def measure(self, count, chats, session_key):
+        from multichat.asgi import application
+
+        headers = [
+            (b"cookie", ("%s=%s" % (settings.SESSION_COOKIE_NAME, session_key)).encode()),
+            (b"origin", b"http://localhost"),
+        ]
+        communicators = []
+
+        async def connect():
+            communicator = WebsocketCommunicator(application, "/chat/%s/" % chats[len(communicators)], headers=headers)
+            connected, _ = await communicator.connect(timeout=10)
+            assert connected
+            # Idle once the join went through
+            while not (await communicator.receive_json_from(timeout=10)).get("join"):
+                pass
+            communicators.append(communicator)
+
+        # The first connection pays for imports and caches
+        await connect()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            for _ in range(count):
+                await connect()
+            gc.collect()
+            per_connection = (tracemalloc.get_traced_memory()[0] - base) / count
+        finally:
+            tracemalloc.stop()
+        # A connection that died while measuring would have freed its memory
+        failed = sum(communicator.future.done() for communicator in communicators)
+        if failed:
+            raise CommandError("%d of %d connections closed while measuring" % (failed, count))
+        for communicator in communicators:
+            await communicator.disconnect()
+        return per_connection
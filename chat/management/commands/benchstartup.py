@@ -0,0 +1,98 @@
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat.models import Order
+from chat.testing import free_port
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the time from starting a Daphne worker to its first accepted websocket "
+        "connection, in the default and the websocket-only worker mode. The workers run on "
+        "a test database with a throwaway user, order and session."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="Worker starts per mode")
+        parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for a worker")
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        if connection.vendor == "sqlite":
+            # The workers are other processes, an in-memory database is out of their reach
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "benchstartup.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            chat_id, session_key = self.create_fixtures()
+            env = dict(os.environ, CHAT_DATABASE=connection.settings_dict["NAME"])
+            for mode in ("default", "websocket"):
+                times = [self.start(mode, chat_id, session_key, env, options["timeout"]) for _ in range(options["runs"])]
+                self.stdout.write("%s mode: first connection accepted after %.3fs median, %.3fs best" % (
+                    mode, statistics.median(times), min(times),
+                ))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(directory)
+
+    def create_fixtures(self):
+        user = User.objects.create_user("startup-benchmark")
+        chat = Order.objects.create(user=user, title="startup benchmark").get_chat(user)
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return chat.pk, session.session_key
+
+    def start(self, mode, chat_id, session_key, env, timeout):
+        port = free_port()
+        start = time.monotonic()
+        worker = subprocess.Popen(
+            [sys.executable, "-m", "daphne", "-b", "127.0.0.1", "-p", str(port), "multichat.asgi:application"],
+            env=dict(env, CHAT_WORKER_MODE=mode), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while time.monotonic() - start < timeout:
+                if self.handshake(port, chat_id, session_key):
+                    return time.monotonic() - start
+                time.sleep(0.01)
+            raise CommandError("No connection accepted by a %s mode worker in %ss" % (mode, timeout))
+        finally:
+            worker.terminate()
+            worker.wait()
+
+    def handshake(self, port, chat_id, session_key):
+        """
+        Opens a websocket and returns whether the server accepted it.
+        """
+        request = (
+            "GET /chat/%s/ HTTP/1.1\r\n"
+            "Host: 127.0.0.1:%s\r\n"
+            "Origin: http://127.0.0.1:%s\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "Cookie: %s=%s\r\n\r\n"
+        ) % (chat_id, port, port, settings.SESSION_COOKIE_NAME, session_key)
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+                sock.sendall(request.encode())
+                return sock.recv(64).startswith(b"HTTP/1.1 101")
+        except OSError:
+            return False
@@ -0,0 +1,300 @@
+import asyncio
+import gc
+import json
+import sys
+import time
+from collections import defaultdict, deque
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from chat import ratelimit, workers
+from chat.middleware import user_record
+from chat.models import Chat, Message, MessageTypes, Order
+from multichat.routing import websocket_urlpatterns
+
+
+User = get_user_model()
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Connection:
+    """
+    One recorded websocket connection, replayed through a communicator.
+    Remembers the messages it sent until their echo comes back, then which
+    of the connections joined to the chat all along must get them too.
+    """
+
+    def __init__(self, application, user, chat_id, latencies, deliveries):
+        self.user = user
+        self.communicator = WebsocketCommunicator(application, "/chat/%s/" % chat_id)
+        # What the auth middleware would have put there
+        self.communicator.scope["user"] = user
+        self.latencies = latencies
+        self.deliveries = deliveries
+        self.pending = defaultdict(deque)
+        self.errors = []
+        self.reader = None
+        self.joined = set()
+        # (chat, message id) pairs received and owed to this connection
+        self.received = set()
+        self.expected = set()
+        self.first_join = asyncio.Event()
+
+    async def open(self):
+        connected, _ = await self.communicator.connect(timeout=5)
+        if connected:
+            self.reader = asyncio.ensure_future(self.read())
+            # Clients wait for the join before they send anything
+            try:
+                await asyncio.wait_for(self.first_join.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+        return connected
+
+    async def read(self):
+        # Reads the output queue directly, receive_output() would cancel the
+        # consumer on a timeout
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message["type"] != "websocket.send":
+                return
+            data = json.loads(message["text"])
+            if "error" in data:
+                self.errors.append(data["error"])
+                self.first_join.set()
+            elif "join" in data:
+                self.joined.add(data["join"])
+                self.first_join.set()
+            elif "id" in data and "chat" in data:
+                key = data["chat"], data["id"]
+                self.received.add(key)
+                if data.get("msg_type") == MessageTypes.MESSAGE and data.get("user_id") == self.user.id:
+                    sent = self.pending.get((data["chat"], data["message"]))
+                    if sent:
+                        when, members = sent.popleft()
+                        self.latencies.append(time.monotonic() - when)
+                        # Whoever left in the meantime may or may not have got it
+                        members = [member for member in members if data["chat"] in member.joined]
+                        for member in members:
+                            member.expected.add(key)
+                        self.deliveries.append((key, members))
+
+    async def send(self, content, members=()):
+        """
+        Sends a recorded command, `members` are the connections joined to
+        the chat of a "send" at the time.
+        """
+        command = content.get("command")
+        if command == "send":
+            self.pending[content.get("chat"), content.get("message")].append((time.monotonic(), members))
+        elif command == "leave":
+            self.joined.discard(content.get("chat"))
+        await self.communicator.send_json_to(content)
+
+    def unconfirmed(self):
+        return [key for key, sent in self.pending.items() for _ in sent]
+
+    def waiting(self):
+        return self.unconfirmed() or self.expected - self.received
+
+    async def close(self):
+        self.joined.clear()
+        if self.reader is not None:
+            await self.communicator.disconnect(timeout=5)
+            self.reader.cancel()
+            self.reader = None
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays websocket traces recorded with CHAT_TRACE_FILE against the consumers, "
+        "on a test database and the in-memory channel layer, and checks for messages lost to "
+        "their sender or any other connection in the chat, "
+        "leaked group memberships, latency and memory drift after every loop."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("traces", nargs="+", help="Trace files, e.g. one per worker")
+        parser.add_argument("--speed", type=float, default=1, help="Replay this many times faster than recorded")
+        parser.add_argument("--loops", type=int, default=1, help="Replay the trace this many times")
+        parser.add_argument("--duration", type=float, help="Keep looping for this many seconds instead")
+        parser.add_argument("--rate-limits", action="store_true", help="Apply CHAT_RATE_LIMITS while replaying")
+        parser.add_argument("--keepdb", action="store_true", help="Keep the test database afterwards")
+
+    def handle(self, *args, **options):
+        chats, users, events = self.load(options["traces"])
+        if not events:
+            raise CommandError("No connections in %s" % ", ".join(options["traces"]))
+        overrides = dict(
+            CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "replay"},
+                "local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "replay-local", "TIMEOUT": 2},
+            },
+        )
+        if not options["rate_limits"]:
+            overrides["CHAT_RATE_LIMITS"] = {}
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        try:
+            with override_settings(**overrides):
+                ratelimit._limiter = None
+                self.create_fixtures(chats, users)
+                failures = asyncio.run(self.soak(events, options))
+        finally:
+            ratelimit._limiter = None
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+        if failures:
+            raise CommandError("%d invariant violations" % failures)
+
+    def load(self, paths):
+        chats, users, events = {}, {}, []
+        for n, path in enumerate(paths):
+            with open(path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record["event"] == "chat":
+                        chats[record["id"]] = record
+                        order = record["order"]
+                        for user in (record["candidate"], order["user"], order["candidate"]):
+                            if user and (user[1] or user[0] not in users):
+                                users[user[0]] = user[1] or "user%s" % user[0]
+                        continue
+                    if record["event"] == "connect":
+                        users[record["user"][0]] = record["user"][1]
+                    # Channel names are only unique within a process
+                    record["conn"] = (n, record["conn"])
+                    events.append(record)
+        # Stable, so events of one connection stay in order on equal times
+        events.sort(key=lambda e: e["t"])
+        return chats, users, events
+
+    def create_fixtures(self, chats, users):
+        now = timezone.now()
+        User.objects.bulk_create([User(id=pk, username=username, last_login=now) for pk, username in users.items()])
+        orders = {chat["order"]["id"]: chat["order"] for chat in chats.values()}
+        Order.objects.bulk_create([
+            Order(
+                id=order["id"], title=order["title"], status=order["status"],
+                user_id=order["user"][0], candidate_id=order["candidate"] and order["candidate"][0],
+            )
+            for order in orders.values()
+        ])
+        Chat.objects.bulk_create([
+            Chat(id=chat["id"], order_id=chat["order"]["id"], candidate_id=chat["candidate"][0], rejected=chat["rejected"])
+            for chat in chats.values()
+        ])
+        self.chat_ids = list(chats)
+        self.records = {pk: user_record(user) for pk, user in User.objects.in_bulk(list(users)).items()}
+
+    async def soak(self, events, options):
+        application = URLRouter(websocket_urlpatterns)
+        deadline = options["duration"] and time.monotonic() + options["duration"]
+        failures = 0
+        baseline = None
+        loop = 0
+        while True:
+            loop += 1
+            start = time.monotonic()
+            stats = await self.replay(application, events, options["speed"])
+            gc.collect()
+            blocks = sys.getallocatedblocks()
+            if baseline is None:
+                baseline = blocks
+            failures += stats["lost"] + stats["leaked groups"] + stats["leaked consumers"]
+            latencies = stats.pop("latencies")
+            self.stdout.write(
+                "loop %d: %.1fs, %s, latency p50 %.1fms p99 %.1fms max %.1fms, %d blocks (%+d)" % (
+                    loop, time.monotonic() - start,
+                    ", ".join("%d %s" % (value, name) for name, value in stats.items()),
+                    percentile(latencies, .5) * 1000, percentile(latencies, .99) * 1000,
+                    max(latencies, default=0) * 1000, blocks, blocks - baseline,
+                )
+            )
+            if deadline and time.monotonic() >= deadline or not deadline and loop >= options["loops"]:
+                return failures
+            await self.reset()
+
+    async def replay(self, application, events, speed):
+        layer = get_channel_layer()
+        latencies = []
+        deliveries = []
+        open_connections = {}
+        stats = dict(connections=0, commands=0, confirmed=0, rejected=0, lost=0)
+        errors = defaultdict(int)
+        start = time.monotonic()
+        first = events[0]["t"]
+
+        async def settle(conn):
+            # Anything stored that the sender never saw is lost, anything not
+            # stored was turned away (access checks, rate limits)
+            for chat_id, text in conn.unconfirmed():
+                if await Message.objects.filter(chat_id=chat_id, user_id=conn.user.id, message=text).aexists():
+                    stats["lost"] += 1
+                else:
+                    stats["rejected"] += 1
+            for error in conn.errors:
+                errors[error] += 1
+
+        for event in events:
+            delay = (event["t"] - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if event["event"] == "connect":
+                conn = Connection(application, self.records[event["user"][0]], event["chat"], latencies, deliveries)
+                if await conn.open():
+                    open_connections[event["conn"]] = conn
+                    stats["connections"] += 1
+            elif event["conn"] in open_connections:
+                conn = open_connections[event["conn"]]
+                if event["event"] == "receive":
+                    chat_id = event["content"].get("chat")
+                    await conn.send(event["content"], [
+                        member for member in open_connections.values() if chat_id in member.joined
+                    ])
+                    stats["commands"] += 1
+                else:
+                    # Give in-flight echoes a moment before hanging up
+                    await self.wait_for(conn)
+                    await conn.close()
+                    del open_connections[event["conn"]]
+                    await settle(conn)
+        for conn in open_connections.values():
+            await self.wait_for(conn)
+            await conn.close()
+            await settle(conn)
+        # Sent to the chat but missed by someone who was in it all along
+        stats["lost"] += sum(1 for key, members in deliveries if any(key not in member.received for member in members))
+        stats["confirmed"] = len(latencies)
+        stats["latencies"] = latencies
+        stats["leaked groups"] = sum(len(channels) for channels in layer.groups.values())
+        stats["leaked consumers"] = len(workers.connections)
+        for name, count in errors.items():
+            stats[name] = count
+        if stats["leaked groups"]:
+            self.stderr.write("Leaked group memberships: %s" % {g: len(c) for g, c in layer.groups.items()})
+        return stats
+
+    async def wait_for(self, conn, timeout=.5):
+        deadline = time.monotonic() + timeout
+        while conn.waiting() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def reset(self):
+        # Start every loop from the same state
+        await Message.objects.all().adelete()
+        await sync_to_async(Chat.refresh_summaries)(*self.chat_ids)
+        await get_channel_layer().flush()
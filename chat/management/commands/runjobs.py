@@ -0,0 +1,84 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F
+from django.utils import timezone
+
+from chat.jobs import run
+from chat.models import Job, JobStatuses
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs background jobs that are due and were not run by the process that enqueued "
+        "them, e.g. because it restarted, requeues jobs that stalled and deletes old finished jobs."
+    )
+    # Rows deleted per query when purging
+    purge_batch = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Run what is due and exit")
+        parser.add_argument("--interval", type=float, default=5, help="Seconds between looking for due jobs")
+        parser.add_argument("--stats", action="store_true", help="Print job throughput and latency of the last hour")
+        parser.add_argument(
+            "--purge-after", type=float, default=86400,
+            help="Delete jobs that finished this many seconds ago, 0 keeps them. "
+                 "Failed jobs and jobs with a key are kept, the key makes enqueueing again a no-op",
+        )
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            return self.stats()
+        while True:
+            self.requeue_stalled()
+            if options["purge_after"]:
+                self.purge(options["purge_after"])
+            for pk in Job.objects.filter(status=JobStatuses.PENDING, run_at__lte=timezone.now()).values_list('pk', flat=True):
+                run(pk)
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
+
+    def requeue_stalled(self):
+        stalled = Job.objects.filter(
+            status=JobStatuses.RUNNING,
+            started__lt=timezone.now() - timedelta(seconds=settings.CHAT_JOB_STALLED_AFTER),
+        ).update(status=JobStatuses.PENDING, run_at=timezone.now())
+        if stalled:
+            self.stderr.write("Requeued %d stalled jobs" % stalled)
+
+    def purge(self, after):
+        done = Job.objects.filter(
+            status=JobStatuses.DONE, key__isnull=True, finished__lt=timezone.now() - timedelta(seconds=after),
+        )
+        purged = 0
+        while True:
+            batch = list(done.values_list('pk', flat=True)[:self.purge_batch])
+            if not batch:
+                break
+            purged += Job.objects.filter(pk__in=batch).delete()[0]
+        if purged:
+            self.stderr.write("Purged %d finished jobs" % purged)
+
+    def stats(self):
+        jobs = Job.objects.filter(created__gte=timezone.now() - timedelta(hours=1))
+        for row in jobs.values('name', 'status').annotate(count=Count('pk')).order_by('name', 'status'):
+            self.stdout.write("%s %s: %d" % (row['name'], JobStatuses(row['status']).label, row['count']))
+        latency = jobs.filter(status=JobStatuses.DONE).aggregate(
+            wait=Avg(ExpressionWrapper(F('started') - F('created'), output_field=DurationField())),
+            duration=Avg(ExpressionWrapper(F('finished') - F('started'), output_field=DurationField())),
+        )
+        if latency['wait'] is not None:
+            self.stdout.write(
+                "average wait %.3fs, average run time %.3fs" % (
+                    latency['wait'].total_seconds(), latency['duration'].total_seconds(),
+                )
+            )
+        self.stdout.write(
+            "%d pending, %d due" % (
+                Job.objects.filter(status=JobStatuses.PENDING).count(),
+                Job.objects.filter(status=JobStatuses.PENDING, run_at__lte=timezone.now()).count(),
+            )
+        )
@@ -0,0 +1,126 @@
+import datetime
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.workers import health_key
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs several Daphne workers on one port. Every worker gets its own SO_REUSEPORT "
+        "socket so the kernel spreads connections over them. SIGTERM/SIGINT drain the "
+        "workers before stopping them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+        parser.add_argument("-b", "--bind", default="127.0.0.1", help="The host/address to bind to")
+        parser.add_argument("-p", "--port", type=int, default=8000, help="Port number to listen on")
+        parser.add_argument("--backlog", type=int, default=1024, help="Listen backlog of every worker socket")
+        parser.add_argument(
+            "--drain-timeout", type=float, default=30,
+            help="Seconds the workers have to move their clients away on shutdown",
+        )
+        parser.add_argument(
+            "--websocket-only", action="store_true",
+            help="Run the workers in websocket mode, without loading the HTTP app",
+        )
+        parser.add_argument("--status", action="store_true", help="Print the health reported by running workers")
+
+    def handle(self, *args, **options):
+        self.options = options
+        if options["status"]:
+            return self.status()
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise CommandError("SO_REUSEPORT is not supported on this platform")
+        self.stopping = False
+        self.workers = {}
+        for worker_id in range(options["workers"]):
+            self.spawn(worker_id)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping:
+            for worker_id, process in list(self.workers.items()):
+                if process.poll() is not None and not self.stopping:
+                    self.stderr.write("Worker %s (pid %s) exited with %s, restarting" % (worker_id, process.pid, process.returncode))
+                    self.spawn(worker_id)
+            time.sleep(1)
+        self.wait()
+
+    def listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.options["bind"], self.options["port"]))
+        sock.listen(self.options["backlog"])
+        return sock
+
+    def spawn(self, worker_id):
+        application = ":".join(settings.ASGI_APPLICATION.rsplit(".", 1))
+        env = dict(
+            os.environ,
+            CHAT_WORKER_ID=str(worker_id),
+            CHAT_DRAIN_TIMEOUT=str(self.options["drain_timeout"]),
+        )
+        if self.options["websocket_only"]:
+            env["CHAT_WORKER_MODE"] = "websocket"
+        with self.listen() as sock:
+            self.workers[worker_id] = subprocess.Popen(
+                [sys.executable, "-m", "daphne", "--fd", str(sock.fileno()), application],
+                pass_fds=[sock.fileno()],
+                env=env,
+                # Keep terminal signals away, the workers are stopped by draining them
+                start_new_session=True,
+            )
+        self.stdout.write("Started worker %s (pid %s)" % (worker_id, self.workers[worker_id].pid))
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        self.stdout.write("Draining %d workers" % len(self.workers))
+        for process in self.workers.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGUSR1)
+
+    def wait(self):
+        # Workers stop by themselves once drained, the margin covers leaving groups
+        deadline = time.monotonic() + self.options["drain_timeout"] + 10
+        for process in self.workers.values():
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.stderr.write("Worker pid %s did not drain in time, terminating" % process.pid)
+                process.terminate()
+        for process in self.workers.values():
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def status(self):
+        for worker_id in range(self.options["workers"]):
+            health = cache.get(health_key(worker_id))
+            if health is None:
+                self.stdout.write("worker %s: no report" % worker_id)
+                continue
+            self.stdout.write(
+                "worker %s: pid %s, %s connections%s, up since %s%s, reported %.0fs ago" % (
+                    worker_id,
+                    health["pid"],
+                    health["connections"],
+                    " (draining)" if health["draining"] else "",
+                    datetime.datetime.fromtimestamp(health["started"]).isoformat(timespec="seconds"),
+                    ", first connection after %.3fs" % (health["first_accepted"] - health["started"])
+                    if health.get("first_accepted") else "",
+                    time.time() - health["updated"],
+                )
+            )
@@ -0,0 +1,51 @@
+import weakref
+
+from channels.auth import AuthMiddleware
+from channels.sessions import CookieMiddleware, SessionMiddleware
+
+
+class UserRecord:
+    """
+    The parts of a User that websocket connections use. Records are interned
+    so all connections of the same user share one.
+    """
+    __slots__ = ('id', 'username', '__weakref__')
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    @property
+    def pk(self):
+        return self.id
+
+
+_records = weakref.WeakValueDictionary()
+
+
+def user_record(user):
+    record = _records.get(user.id)
+    if record is None or record.username != user.username:
+        record = _records[user.id] = UserRecord(user.id, user.username)
+    return record
+
+
+class UserRecordAuthMiddleware(AuthMiddleware):
+    """
+    AuthMiddleware that puts a UserRecord in the scope rather than the User,
+    which every middleware's copy of the scope keeps alive for as long as
+    the connection lasts.
+    """
+
+    async def resolve_scope(self, scope):
+        await super().resolve_scope(scope)
+        user = scope["user"]._wrapped
+        if user.is_authenticated:
+            scope["user"] = user_record(user)
+
+
+def UserRecordAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(UserRecordAuthMiddleware(inner)))
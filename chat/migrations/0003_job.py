@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chat_timestamp_alter_message_msg_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('args', models.JSONField(default=list)),
+                ('key', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Running'), (2, 'Done'), (3, 'Failed')], default=0)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_at'], name='chat_job_status_177a5d_idx')],
+            },
+        ),
+    ]
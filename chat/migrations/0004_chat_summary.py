@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:19
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_summaries(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    messages = Message.objects.filter(chat=OuterRef('pk')).order_by()
+    latest = messages.order_by('-timestamp', '-pk')
+
+    def count_of(messages):
+        return Coalesce(Subquery(messages.values('chat').annotate(count=Count('pk')).values('count')), 0)
+
+    Chat.objects.update(
+        last_message=Subquery(latest.values('pk')[:1]),
+        last_activity=Coalesce(Subquery(latest.values('timestamp')[:1]), F('timestamp')),
+        message_count=count_of(messages),
+        unread_count=count_of(messages.filter(unread=True)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_job'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['candidate', '-last_activity'], name='chat_chat_candida_da60f9_idx'),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chat_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='msg_type',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Message'), (1, 'Info'), (2, 'Status'), (3, 'Enter'), (4, 'Leave'), (5, 'Typing'), (6, 'Ping'), (7, 'Receipt')], default=0),
+        ),
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivered', models.PositiveIntegerField(default=0)),
+                ('read', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chat.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('chat', 'user')},
+            },
+        ),
+    ]
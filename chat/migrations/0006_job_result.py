@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_readstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='result',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
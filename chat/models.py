@@ -1,12 +1,22 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
+from .cache import bump_version, chat_key, invalidate, order_key
+
 
 User = get_user_model()
-channel_layer = get_channel_layer()
+
+
+def count_of(messages):
+    """
+    Number of rows in a subquery of messages correlated to the chat.
+    """
+    return Coalesce(Subquery(messages.values('chat').annotate(count=Count('pk')).values('count')), 0)
 
 
 class OrderStatuses(models.IntegerChoices):
@@ -24,6 +34,14 @@ class MessageTypes(models.IntegerChoices):
     LEAVE = 4
     TYPING = 5
     PING = 6
+    RECEIPT = 7
+
+
+class JobStatuses(models.IntegerChoices):
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
 
 
 class Order(models.Model):
@@ -34,31 +52,60 @@ class Order(models.Model):
         choices=OrderStatuses.choices, default=OrderStatuses.DRAFT
     )
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        bump_version('orders')
+        if not adding:
+            self.invalidate_cache()
+
+    def delete(self, *args, **kwargs):
+        self.invalidate_cache()
+        result = super().delete(*args, **kwargs)
+        bump_version('orders')
+        # Chats and their messages go away with the order
+        bump_version('messages')
+        return result
+
+    def invalidate_cache(self):
+        # Cached chats carry their order along, so they go stale with it
+        invalidate(order_key(self.pk), *(chat_key(pk) for pk in self.chat_set.values_list('pk', flat=True)))
+
     def get_chat(self, user):
         return self.chat_set.get_or_create(order=self, candidate=user)[0]
 
     def to_status(self, status):
-        self.status = status
-        self.save(update_fields=['status'])
+        from .jobs import enqueue
+        with transaction.atomic():
+            # Setting the status the order already has doesn't tell the chats again
+            current = Order.objects.select_for_update().values_list('status', flat=True).get(pk=self.pk)
+            self.status = status
+            if current == status:
+                return
+            self.save(update_fields=['status'])
+            # Telling the chats about it happens in the background
+            enqueue('order_status_changed', self.pk, status)
+
+    def status_messages(self, status):
+        """
+        Stores the messages telling the chats about a status change and
+        returns them, sending is up to the caller (see jobs.send_messages).
+        """
         if status == OrderStatuses.STARTED:
-            self.group_message(msg_type=MessageTypes.STATUS, message='Выбран кандидат')
-            self.chat_set.get(candidate=self.candidate).group_message(
-                msg_type=MessageTypes.STATUS, message="Вас выбрали исполнителем", writable=True
-            )
+            return self.add_messages(msg_type=MessageTypes.STATUS, message='Выбран кандидат') + [
+                self.chat_set.get(candidate=self.candidate).add_message(
+                    msg_type=MessageTypes.STATUS, message="Вас выбрали исполнителем"
+                )
+            ]
         elif status == OrderStatuses.ON_HOLD:
-            self.group_message(msg_type=MessageTypes.STATUS, message='Заказ приостановлен')
+            return self.add_messages(msg_type=MessageTypes.STATUS, message='Заказ приостановлен')
         elif status == OrderStatuses.PUBLISHED:
-            self.group_message(msg_type=MessageTypes.STATUS, message='Снова можно писать')
+            return self.add_messages(msg_type=MessageTypes.STATUS, message='Снова можно писать')
+        return []
 
-    def group_message(self, **kwargs):
-        for chat in self.chat_set.all():
-            chat.message_set.create(**kwargs)
-        kwargs['timestamp'] = timezone.now().isoformat()
-        async_to_sync(channel_layer.group_send)(self.group_name, kwargs)
-
-    @property
-    def group_name(self):
-        return "order-%s" % self.id
+    def add_messages(self, **kwargs):
+        # One per chat, connections don't subscribe to the order
+        return [chat.add_message(**kwargs) for chat in self.chat_set.all()]
 
 
 class Chat(models.Model):
@@ -66,19 +113,37 @@ class Chat(models.Model):
     candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='candidate_chats')
     rejected = models.BooleanField(default=False)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Summary kept up to date by Message.save/delete and update_unread_counts so
+    # chat lists don't aggregate over messages. Not refreshed in cached chats.
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_activity = models.DateTimeField(default=timezone.now, db_index=True)
+    message_count = models.PositiveIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.group_name
 
+    class Meta:
+        indexes = [models.Index(fields=['candidate', '-last_activity'])]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate(chat_key(self.pk))
+
+    def delete(self, *args, **kwargs):
+        invalidate(chat_key(self.pk))
+        return super().delete(*args, **kwargs)
+
     def users(self):
         return [self.order.user, self.candidate]
 
     def is_writable(self, user):
-        if self.order.status == OrderStatuses.STARTED.value and self.order.candidate != user and self.order.user != user:
+        # Compares ids, user can be a User or a chat.middleware.UserRecord
+        if self.order.status == OrderStatuses.STARTED.value and self.order.candidate_id != user.id and self.order.user_id != user.id:
             return False
-        if self.rejected and self.order.user != user:
+        if self.rejected and self.order.user_id != user.id:
             return False
-        if self.order.candidate and self.order.candidate != user and self.order.user != user:
+        if self.order.candidate_id and self.order.candidate_id != user.id and self.order.user_id != user.id:
             return False
         return True
 
@@ -87,22 +152,63 @@ class Chat(models.Model):
         return "chat-%s" % self.id
 
     def reject(self):
+        from .jobs import enqueue
         self.rejected = True
         self.save(update_fields=['rejected'])
-        self.message_set.create(
-            msg_type=MessageTypes.STATUS, user=self.order.user, message='Вам отказали'
-        ).send()
+        # Once per chat, rejecting again doesn't repeat the message
+        enqueue('chat_message', self.pk, self.order.user_id, 'Вам отказали', key='chat-%s-rejected' % self.pk)
 
     def approve(self):
-        self.order.candidate = self.candidate
-        self.order.save(update_fields=['candidate'])
-        self.message_set.create(
-            msg_type=MessageTypes.STATUS, user=self.order.user, message='Ваc выбрали исполнителем'
-        ).send()
+        from .jobs import enqueue
+        with transaction.atomic():
+            # Approving the current candidate again is a no-op
+            current = Order.objects.select_for_update().values_list('candidate', flat=True).get(pk=self.order_id)
+            self.order.candidate = self.candidate
+            if current == self.candidate_id:
+                return
+            self.order.save(update_fields=['candidate'])
+            # Once per approval, a candidate chosen again after someone else is told again
+            enqueue(
+                'chat_message', self.pk, self.order.user_id, 'Ваc выбрали исполнителем',
+                key='chat-%s-approved-%s' % (self.pk, timezone.now().timestamp()),
+            )
+
+    def add_message(self, **kwargs):
+        return self.message_set.create(**kwargs)
+
+    @classmethod
+    def message_added(cls, message):
+        # Concurrent inserts may land out of order, only move forward
+        newer = Q(last_activity__lte=message.timestamp)
+        cls.objects.filter(pk=message.chat_id).update(
+            last_message=Case(
+                When(newer, then=Value(message.pk)), default=F('last_message'),
+                output_field=cls._meta.get_field('last_message'),
+            ),
+            last_activity=Case(When(newer, then=Value(message.timestamp)), default=F('last_activity')),
+            message_count=F('message_count') + 1,
+            unread_count=F('unread_count') + int(message.unread),
+        )
 
-    def group_message(self, **kwargs):
-        msg = self.message_set.create(**kwargs)
-        async_to_sync(channel_layer.group_send)(self.group_name, msg.to_json())
+    @classmethod
+    def refresh_summaries(cls, *chat_ids):
+        """
+        Recomputes the summary of the given chats from their messages.
+        """
+        messages = Message.objects.filter(chat=OuterRef('pk')).order_by()
+        latest = messages.order_by('-timestamp', '-pk')
+        cls.objects.filter(pk__in=chat_ids).update(
+            last_message=Subquery(latest.values('pk')[:1]),
+            last_activity=Coalesce(Subquery(latest.values('timestamp')[:1]), F('timestamp')),
+            message_count=count_of(messages),
+            unread_count=count_of(messages.filter(unread=True)),
+        )
+
+    @classmethod
+    def update_unread_counts(cls, *chat_ids):
+        cls.objects.filter(pk__in=chat_ids).update(
+            unread_count=count_of(Message.objects.filter(chat=OuterRef('pk'), unread=True).order_by()),
+        )
 
 
 class Message(models.Model):
@@ -113,8 +219,28 @@ class Message(models.Model):
     message = models.TextField(null=True, blank=True)
     unread = models.BooleanField(default=True)
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            Chat.message_added(self)
+        self.bump_versions(self.chat_id)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Chat.refresh_summaries(self.chat_id)
+        self.bump_versions(self.chat_id)
+        return result
+
+    @staticmethod
+    def bump_versions(*chat_ids):
+        bump_version('messages')
+        for chat_id in chat_ids:
+            bump_version('messages', chat_id)
+
     def to_json(self):
         return {
+            "id": self.pk,
             "msg_type": self.msg_type,
             "username": self.user and self.user.username,
             "timestamp": self.timestamp.isoformat(),
@@ -123,7 +249,86 @@ class Message(models.Model):
         }
 
     def send(self):
-        async_to_sync(channel_layer.group_send)(self.chat.group_name, self.to_json())
+        async_to_sync(get_channel_layer().group_send)(
+            self.chat.group_name,
+            dict(self.to_json(), type="chat.notice", chat=self.chat_id),
+        )
 
     class Meta:
         ordering = ['timestamp']
+
+
+class ReadState(models.Model):
+    """
+    How far a user got in a chat: ids of the last message delivered to them
+    and the last one they read. Moves forward only. Message.unread and
+    Chat.unread_count follow the read watermark, see advance().
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    delivered = models.PositiveIntegerField(default=0)
+    read = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('chat', 'user')]
+
+    def to_json(self):
+        return {"user_id": self.user_id, "delivered": self.delivered, "read": self.read}
+
+    @classmethod
+    def advance(cls, chat_id, marks):
+        """
+        Moves the watermarks of chat `chat_id` to `marks`, {user_id: (delivered, read)}.
+        Ids past the chat's last message are cut down to it. Other people's
+        messages the read watermark moved over are marked read, only the
+        newly read range is touched.
+
+        Returns the states that changed and how many messages were marked read.
+        """
+        changed, marked = [], 0
+        with transaction.atomic():
+            last = Message.objects.filter(chat_id=chat_id).aggregate(last=Max('pk'))['last'] or 0
+            for user_id, (delivered, read) in marks.items():
+                state = cls.objects.select_for_update().get_or_create(chat_id=chat_id, user_id=user_id)[0]
+                # Reading a message means it was delivered
+                read = max(state.read, min(read, last))
+                delivered = max(state.delivered, min(delivered, last), read)
+                if (delivered, read) == (state.delivered, state.read):
+                    continue
+                if read > state.read:
+                    marked += Message.objects.filter(
+                        chat_id=chat_id, pk__gt=state.read, pk__lte=read, unread=True,
+                    ).exclude(user_id=user_id).update(unread=False)
+                state.delivered, state.read = delivered, read
+                state.save(update_fields=['delivered', 'read', 'updated'])
+                changed.append(state)
+            if marked:
+                Chat.update_unread_counts(chat_id)
+                Message.bump_versions(chat_id)
+        return changed, marked
+
+
+class Job(models.Model):
+    """
+    Side effect to run in the background, see chat.jobs.
+    """
+    name = models.CharField(max_length=128)
+    args = models.JSONField(default=list)
+    # Enqueueing again with the same key is a no-op
+    key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.PositiveSmallIntegerField(choices=JobStatuses.choices, default=JobStatuses.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_at = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    # Job specific progress kept across retries, see jobs.send_messages
+    result = models.JSONField(null=True, blank=True)
+
+    def __str__(self):
+        return "%s%s" % (self.name, tuple(self.args))
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'])]
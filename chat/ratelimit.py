@@ -0,0 +1,121 @@
+import logging
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LocalRateLimiter:
+    """
+    Token buckets kept in this process, one per user and command.
+    """
+    # Forget about full buckets once there are this many
+    prune_at = 10000
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+
+    async def allow(self, user_id, command):
+        try:
+            rate, capacity = self.limits[command]
+        except KeyError:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get((user_id, command))
+        if bucket is None:
+            if len(self.buckets) >= self.prune_at:
+                self.prune(now)
+            bucket = self.buckets[user_id, command] = TokenBucket(rate, capacity, now)
+        return bucket.consume(now)
+
+    def prune(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+
+class RedisRateLimiter:
+    """
+    Token buckets shared by all nodes through Redis. The bucket is updated
+    by a script so it is atomic, and uses the Redis clock so nodes don't
+    need to agree on the time. If Redis can't be reached commands are let
+    through rather than rejecting everyone.
+    """
+    script = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return allowed
+    """
+
+    def __init__(self, limits, url):
+        from redis.asyncio import Redis
+
+        self.limits = limits
+        self.redis = Redis.from_url(url)
+        self.bucket = self.redis.register_script(self.script)
+
+    async def allow(self, user_id, command):
+        try:
+            rate, capacity = self.limits[command]
+        except KeyError:
+            return True
+        try:
+            return bool(await self.bucket(keys=["ratelimit-%s-%s" % (user_id, command)], args=[rate, capacity]))
+        except Exception:
+            logger.exception("Rate limiting through Redis failed")
+            return True
+
+
+_limiter = None
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        if settings.CHAT_RATE_LIMIT_BACKEND == 'redis':
+            _limiter = RedisRateLimiter(settings.CHAT_RATE_LIMITS, settings.CHAT_RATE_LIMIT_REDIS)
+        else:
+            _limiter = LocalRateLimiter(settings.CHAT_RATE_LIMITS)
+    return _limiter
+
+
+async def allow(user_id, command):
+    return await get_limiter().allow(user_id, command)
@@ -0,0 +1,79 @@
+"""
+Delivery and read receipts.
+
+Clients acknowledge the highest message id they got ("ack") and read
+("read"). Those are buffered per chat in each process and every
+CHAT_RECEIPT_INTERVAL seconds written to the ReadState watermarks and sent
+to the chat group as a single chat.receipt event, however many came in.
+Workers flush the buffer when they drain (see workers.drain); receipts
+still in it when a process dies are lost, clients send their watermark
+again with the next message anyway.
+"""
+
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .models import ReadState
+
+
+logger = logging.getLogger(__name__)
+
+# chat id -> {user id: (delivered, read)}
+_pending = {}
+# Flushes in progress, so they aren't garbage collected half way
+_flushing = set()
+
+
+def acknowledge(chat_id, user_id, delivered=0, read=0):
+    marks = _pending.get(chat_id)
+    if marks is None:
+        marks = _pending[chat_id] = {}
+        asyncio.get_running_loop().call_later(settings.CHAT_RECEIPT_INTERVAL, _start_flush, chat_id)
+    old_delivered, old_read = marks.get(user_id, (0, 0))
+    marks[user_id] = (max(old_delivered, delivered), max(old_read, read))
+
+
+def _start_flush(chat_id):
+    marks = _pending.pop(chat_id, None)
+    if marks is None:
+        # flush_all() got to it first
+        return
+    task = asyncio.ensure_future(flush(chat_id, marks))
+    _flushing.add(task)
+    task.add_done_callback(_flushing.discard)
+
+
+async def flush_all():
+    """
+    Stores and sends everything buffered right away, for when the worker
+    shuts down.
+    """
+    while _pending:
+        chat_id, marks = _pending.popitem()
+        await flush(chat_id, marks)
+    if _flushing:
+        await asyncio.gather(*_flushing, return_exceptions=True)
+
+
+async def flush(chat_id, marks):
+    try:
+        changed, _ = await sync_to_async(ReadState.advance)(chat_id, marks)
+        if changed:
+            await broadcast(chat_id, changed)
+    except Exception:
+        logger.exception("Storing receipts of chat %s failed", chat_id)
+
+
+async def broadcast(chat_id, states):
+    await get_channel_layer().group_send(
+        "chat-%s" % chat_id,
+        {
+            "type": "chat.receipt",
+            "chat_id": chat_id,
+            "receipts": [state.to_json() for state in states],
+        }
+    )
@@ -0,0 +1,55 @@
+"""
+Helpers for tests and benchmarks that need real servers.
+"""
+
+import contextlib
+import shutil
+import socket
+import subprocess
+import time
+
+import redis
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def redis_servers(count, executable="redis-server"):
+    """
+    Starts `count` throwaway Redis servers without persistence on free local
+    ports and yields their (host, port) pairs.
+    """
+    path = shutil.which(executable)
+    if path is None:
+        raise RuntimeError("%s is not on PATH" % executable)
+    processes, hosts = [], []
+    try:
+        for _ in range(count):
+            port = free_port()
+            processes.append(subprocess.Popen(
+                [path, "--port", str(port), "--bind", "127.0.0.1", "--save", "", "--appendonly", "no"],
+                stdout=subprocess.DEVNULL,
+            ))
+            hosts.append(("127.0.0.1", port))
+        for host, port in hosts:
+            client = redis.Redis(host=host, port=port)
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    client.ping()
+                    break
+                except redis.ConnectionError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+            client.close()
+        yield hosts
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
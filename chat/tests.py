@@ -0,0 +1,544 @@
+import json
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+import redis
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from chat import jobs, ratelimit, receipts, trace, workers
+from chat.cache import chat_key, get_cached, get_version, order_key
+from chat.consumers import ChatConsumer
+from chat.layers import ShardedChannelLayer, jump_hash
+from chat.management.commands import replaytrace
+from chat.models import Chat, Job, JobStatuses, Message, MessageTypes, Order, OrderStatuses, ReadState
+from chat.ratelimit import LocalRateLimiter, TokenBucket
+from chat.testing import redis_servers
+from chat.utils import CHAT_FIELDS, CHAT_RELATED
+
+
+User = get_user_model()
+
+
+class FlakySend:
+    """
+    Stands in for Message.send, failing the first `failures` calls.
+    """
+
+    def __init__(self, failures=1):
+        self.failures = failures
+        self.sent = []
+
+    def __call__(self, message):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("channel layer down")
+        self.sent.append(message.pk)
+
+
+class JobRetryTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.order = Order.objects.create(user=self.owner, title='order', status=OrderStatuses.PUBLISHED)
+        self.chats = [self.order.get_chat(User.objects.create_user(name)) for name in ('first', 'second')]
+
+    def retry(self, job):
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        jobs.run(job.pk)
+        job.refresh_from_db()
+
+    def test_status_change_retry_sends_stored_messages(self):
+        send = FlakySend()
+        with mock.patch.object(Message, 'send', autospec=True, side_effect=send):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.order.to_status(OrderStatuses.ON_HOLD)
+            job = Job.objects.get(name='order_status_changed')
+            self.assertEqual(job.status, JobStatuses.PENDING)
+            self.retry(job)
+        messages = Message.objects.filter(message='Заказ приостановлен')
+        self.assertEqual(messages.count(), 2)
+        self.assertEqual(job.status, JobStatuses.DONE)
+        self.assertEqual(sorted(send.sent), sorted(messages.values_list('pk', flat=True)))
+
+    def test_retry_only_sends_what_failed(self):
+        self.order.candidate = self.chats[0].candidate
+        self.order.save()
+        # The group message to the first chat goes out, the second one fails
+        sent = []
+        calls = iter([None, ConnectionError("channel layer down")])
+
+        def send(message):
+            error = next(calls, None)
+            if error:
+                raise error
+            sent.append(message.pk)
+
+        with mock.patch.object(Message, 'send', autospec=True, side_effect=send):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.order.to_status(OrderStatuses.STARTED)
+            job = Job.objects.get(name='order_status_changed')
+            self.retry(job)
+        # Two group messages plus the one to the chosen candidate, each sent once
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(sorted(sent), sorted(Message.objects.values_list('pk', flat=True)))
+        self.assertEqual(job.status, JobStatuses.DONE)
+
+    def test_chat_message_retry(self):
+        send = FlakySend()
+        with mock.patch.object(Message, 'send', autospec=True, side_effect=send):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.chats[0].reject()
+            job = Job.objects.get(name='chat_message')
+            self.retry(job)
+            # Rejecting again is a no-op
+            with self.captureOnCommitCallbacks(execute=True):
+                self.chats[0].reject()
+        self.assertEqual(list(Message.objects.values_list('pk', flat=True)), send.sent)
+        self.assertEqual(len(send.sent), 1)
+
+
+class RepeatTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.order = Order.objects.create(user=self.owner, title='order', status=OrderStatuses.PUBLISHED)
+        self.first, self.second = (self.order.get_chat(User.objects.create_user(name)) for name in ('first', 'second'))
+
+    def test_approving_again_after_someone_else(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for chat in (self.first, self.first, self.second, self.first):
+                chat.approve()
+        self.assertEqual(Message.objects.filter(chat=self.first).count(), 2)
+        self.assertEqual(Message.objects.filter(chat=self.second).count(), 1)
+
+    def test_setting_the_same_status_again(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for status in (OrderStatuses.ON_HOLD, OrderStatuses.ON_HOLD, OrderStatuses.PUBLISHED, OrderStatuses.ON_HOLD):
+                self.order.to_status(status)
+        self.assertEqual(Job.objects.filter(name='order_status_changed').count(), 3)
+        self.assertEqual(Message.objects.filter(chat=self.first, message='Заказ приостановлен').count(), 2)
+
+    @skipUnless(connection.vendor == 'sqlite', "sets an SQLite limit")
+    def test_last_logins_in_chunks(self):
+        when = timezone.now()
+        users = User.objects.bulk_create([User(username='user%d' % n) for n in range(600)])
+        # Builds differ, hold this one to the limit Django assumes
+        limit = connection.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, connection.features.max_query_params)
+        self.addCleanup(connection.connection.setlimit, sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+        jobs.update_last_logins({str(user.pk): when.isoformat() for user in users})
+        self.assertEqual(User.objects.filter(last_login=when).count(), 600)
+
+
+class VersionTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        self.chat = Order.objects.create(user=owner, title='order').get_chat(User.objects.create_user('candidate'))
+
+    def test_bumped_on_commit(self):
+        before = get_version('messages', self.chat.pk), get_version('orders')
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(chat=self.chat, message='hi')
+            self.chat.order.save()
+            self.assertEqual((get_version('messages', self.chat.pk), get_version('orders')), before)
+        self.assertGreater(get_version('messages', self.chat.pk), before[0])
+        self.assertGreater(get_version('orders'), before[1])
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='a')
+        self.chat = Order.objects.create(user=self.owner, title='order').get_chat(User.objects.create_user('candidate'))
+        self.client.login(username='owner', password='a')
+
+    def test_new_message_within_the_same_second(self):
+        for url in ('/messages/?chat=%s' % self.chat.pk, '/messages/?chat=0%s' % self.chat.pk):
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(chat=self.chat, message='first')
+            response = self.client.get(url)
+            self.assertFalse(response.has_header('Last-Modified'))
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(chat=self.chat, message='second')
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_invalid_chat_is_a_bad_request(self):
+        self.assertEqual(self.client.get('/messages/?chat=abc').status_code, 400)
+
+
+class CacheTests(TestCase):
+    def setUp(self):
+        # Ids come round again in every test, so do rows cached by earlier ones
+        cache.clear()
+        caches['local'].clear()
+
+    def test_invalidated_on_commit(self):
+        order = Order.objects.create(user=User.objects.create_user('owner'), title='order')
+        key = order_key(order.pk)
+        stale = get_cached(key, lambda: Order.objects.get(pk=order.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            order.candidate = User.objects.create_user('candidate')
+            order.save()
+            # Someone reading before the commit caches the old row again
+            cache.set(key, stale)
+            caches['local'].set(key, stale)
+        self.assertEqual(get_cached(key, lambda: Order.objects.get(pk=order.pk)).candidate_id, order.candidate_id)
+
+    def test_start_chat(self):
+        owner = User.objects.create_user('owner', password='a')
+        order = Order.objects.create(user=owner, title='order', status=OrderStatuses.PUBLISHED)
+        client = Client()
+        client.login(username='owner', password='a')
+        self.assertEqual(client.get('/orders/abc/start_chat/').status_code, 404)
+        self.assertEqual(client.get('/orders/%s/start_chat/' % (order.pk + 1)).status_code, 404)
+        self.assertEqual(client.get('/orders/0%s/start_chat/' % order.pk).status_code, 302)
+        self.assertEqual(cache.get(order_key(order.pk)), order)
+
+    def test_cached_chat_leaves_out_user_rows(self):
+        owner = User.objects.create_user('owner', password='a')
+        chat = Order.objects.create(user=owner, title='order').get_chat(User.objects.create_user('candidate', password='a'))
+        client = Client()
+        client.login(username='owner', password='a')
+        self.assertEqual(client.get('/chats/%s/' % chat.pk).status_code, 200)
+        cached = cache.get(chat_key(chat.pk))
+        self.assertEqual([user.username for user in cached.users()], ['owner', 'candidate'])
+        self.assertEqual(cached.order.user.get_deferred_fields() & {'password', 'email'}, {'password', 'email'})
+        self.assertNotIn(owner.password.encode(), pickle.dumps(cached))
+
+
+class ReadStateTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='a')
+        self.candidate = User.objects.create_user('candidate', password='a')
+        self.chat = Order.objects.create(user=self.owner, title='order').get_chat(self.candidate)
+        for n in range(30):
+            Message.objects.create(chat=self.chat, user=self.owner, message=str(n))
+        self.own = Message.objects.create(chat=self.chat, user=self.candidate, message='mine')
+        self.last = self.own.pk
+
+    def unread(self):
+        self.chat.refresh_from_db()
+        return Message.objects.filter(chat=self.chat, unread=True).count(), self.chat.unread_count
+
+    def test_read_watermark_marks_messages(self):
+        changed, marked = ReadState.advance(self.chat.pk, {self.candidate.pk: (0, self.last - 11)})
+        self.assertEqual((changed[0].delivered, changed[0].read, marked), (self.last - 11, self.last - 11, 20))
+        self.assertEqual(self.unread(), (11, 11))
+        # Only the newly read range is touched, and never one's own messages
+        changed, marked = ReadState.advance(self.chat.pk, {self.candidate.pk: (0, 10 ** 9)})
+        self.assertEqual((changed[0].read, marked), (self.last, 10))
+        self.assertEqual(self.unread(), (1, 1))
+        self.assertTrue(Message.objects.get(pk=self.own.pk).unread)
+        # Watermarks don't move back
+        self.assertEqual(ReadState.advance(self.chat.pk, {self.candidate.pk: (1, 1)}), ([], 0))
+
+    def test_mark_read_all(self):
+        client = Client()
+        client.login(username='candidate', password='a')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.get('/messages/mark_read_all/?chat=%s' % self.chat.pk)
+        self.assertEqual(response.json(), {'updated': 30})
+        self.assertEqual(ReadState.objects.get(user=self.candidate).read, self.last)
+        self.assertEqual(Job.objects.get(name='send_receipts').status, JobStatuses.DONE)
+        self.assertEqual(client.get('/messages/mark_read_all/?chat=%s' % self.chat.pk).json(), {'updated': 0})
+
+
+class DrainTests(TestCase):
+    def setUp(self):
+        from twisted.internet import reactor
+
+        self.reactor = reactor
+        owner = User.objects.create_user('owner')
+        self.candidate = User.objects.create_user('candidate')
+        self.chat = Order.objects.create(user=owner, title='order').get_chat(self.candidate)
+        self.message = Message.objects.create(chat=self.chat, user=owner, message='hi')
+        self.addCleanup(setattr, workers, 'draining', False)
+
+    def test_drain_flushes_buffers_without_the_cache(self):
+        receipts._pending[self.chat.pk] = {self.candidate.pk: (0, self.message.pk)}
+        jobs._last_logins[str(self.candidate.pk)] = timezone.now().isoformat()
+        with mock.patch.object(workers, 'report_health', side_effect=ConnectionError("cache down")), \
+                mock.patch.object(self.reactor, 'getReaders', return_value=[]), \
+                mock.patch.object(self.reactor, 'stop') as stop, \
+                self.captureOnCommitCallbacks(execute=True), \
+                self.assertLogs('chat.workers', 'ERROR'):
+            async_to_sync(workers.drain)()
+        stop.assert_called_once_with()
+        self.assertEqual(ReadState.objects.get(user=self.candidate).read, self.message.pk)
+        self.assertTrue(Job.objects.filter(name='update_last_logins').exists())
+        self.assertEqual(receipts._pending, {})
+
+
+def websocket(client, path):
+    """
+    A communicator for `path` on the full ASGI stack, logged in as `client`.
+    """
+    from multichat.asgi import application
+
+    return WebsocketCommunicator(application, path, headers=[
+        (b'cookie', ('%s=%s' % (settings.SESSION_COOKIE_NAME, client.cookies[settings.SESSION_COOKIE_NAME].value)).encode()),
+        (b'origin', b'http://localhost'),
+    ])
+
+
+class ResumeTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='a')
+        self.chat = Order.objects.create(user=self.owner, title='order').get_chat(User.objects.create_user('candidate'))
+        self.messages = [Message.objects.create(chat=self.chat, user=self.owner, message=str(n)) for n in range(3)]
+        self.client.login(username='owner', password='a')
+
+    async def join(self, path):
+        communicator = websocket(self.client, path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        history = []
+        while True:
+            content = await communicator.receive_json_from()
+            if content.get('join'):
+                return communicator, history
+            if 'id' in content:
+                history.append(content['id'])
+
+    async def drain_and_resume(self):
+        communicator, history = await self.join('/chat/%s/' % self.chat.pk)
+        self.assertEqual(history, [message.pk for message in self.messages])
+        await communicator.send_json_to({'command': 'send', 'chat': self.chat.pk, 'message': 'hi'})
+        sent = (await communicator.receive_json_from())['id']
+        consumer, = workers.connections
+        await consumer.drain()
+        self.assertEqual(await communicator.receive_json_from(), {
+            'reconnect': True, 'chats': [{'chat': self.chat.pk, 'after': sent}],
+        })
+        self.assertEqual((await communicator.receive_output())['code'], 4012)
+        await communicator.wait()
+        missed = await Message.objects.acreate(chat=self.chat, user=self.owner, message='missed')
+        communicator, history = await self.join('/chat/%s/?after=%s' % (self.chat.pk, sent))
+        self.assertEqual(history, [missed.pk])
+        # Joining again with a position sends nothing before it either
+        await communicator.send_json_to({'command': 'join', 'chat': self.chat.pk, 'after': missed.pk})
+        self.assertEqual((await communicator.receive_json_from())['msg_type'], MessageTypes.INFO)
+        self.assertEqual(await communicator.receive_json_from(), {'join': self.chat.pk, 'title': 'order'})
+        await communicator.disconnect()
+
+    def test_drain_hint_resumes_after_the_last_message(self):
+        async_to_sync(self.drain_and_resume)()
+
+
+class ReplayTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('owner', password='a')
+        self.chat = Order.objects.create(user=owner, title='order').get_chat(User.objects.create_user('candidate', password='a'))
+        self.clients = []
+        for username in ('owner', 'candidate'):
+            client = Client()
+            client.login(username=username, password='a')
+            self.clients.append(client)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'trace.jsonl')
+        self.addCleanup(self.reset_trace)
+        with override_settings(CHAT_TRACE_FILE=self.path):
+            async_to_sync(self.record)()
+        self.reset_trace()
+        # The replay brings its own rows
+        User.objects.all().delete()
+
+    def reset_trace(self):
+        if trace._file:
+            trace._file.close()
+        trace._file = trace._start = None
+        trace._chats.clear()
+
+    async def record(self):
+        communicators = []
+        for client in self.clients:
+            communicator = websocket(client, '/chat/%s/' % self.chat.pk)
+            await communicator.connect()
+            while not (await communicator.receive_json_from()).get('join'):
+                pass
+            communicators.append(communicator)
+        for n, communicator in enumerate(communicators):
+            await communicator.send_json_to({'command': 'send', 'chat': self.chat.pk, 'message': 'hi %d' % n})
+            for receiver in communicators:
+                while (await receiver.receive_json_from()).get('msg_type') != MessageTypes.MESSAGE:
+                    pass
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    def replay(self):
+        command = replaytrace.Command(stdout=StringIO(), stderr=StringIO())
+        chats, users, events = command.load([self.path])
+        self.assertEqual([event['event'] for event in events], ['connect', 'connect', 'receive', 'receive', 'disconnect', 'disconnect'])
+        command.create_fixtures(chats, users)
+        with override_settings(CHAT_RATE_LIMITS={}):
+            failures = async_to_sync(command.soak)(events, {'speed': 10, 'loops': 1, 'duration': None})
+        return failures, command.stdout.getvalue()
+
+    def test_replay(self):
+        failures, output = self.replay()
+        self.assertEqual(failures, 0)
+        self.assertIn('2 connections, 2 commands, 2 confirmed, 0 rejected, 0 lost', output)
+
+    def test_message_missed_by_another_member_is_lost(self):
+        chat_message = ChatConsumer.chat_message
+
+        async def drop_others(consumer, event):
+            # The candidate only gets their own messages
+            if consumer.scope['user'].username != 'candidate' or event['user_id'] == consumer.scope['user'].id:
+                await chat_message(consumer, event)
+
+        with mock.patch.object(ChatConsumer, 'chat_message', drop_others):
+            failures, output = self.replay()
+        self.assertEqual(failures, 1)
+        self.assertIn('2 confirmed, 0 rejected, 1 lost', output)
+
+
+class TraceTests(TestCase):
+    def test_chat_record_from_a_cached_chat(self):
+        candidate = User.objects.create_user('candidate')
+        order = Order.objects.create(user=User.objects.create_user('owner'), candidate=candidate, title='order')
+        chat = Chat.objects.select_related(*CHAT_RELATED).only(*CHAT_FIELDS).get(pk=order.get_chat(candidate).pk)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'trace.jsonl')
+        self.addCleanup(setattr, trace, '_file', None)
+        self.addCleanup(trace._chats.clear)
+        # Nothing past what the cache has, the consumers record from async code
+        with override_settings(CHAT_TRACE_FILE=path), self.assertNumQueries(0):
+            trace.record_chat(chat)
+        trace._file.close()
+        with open(path) as f:
+            self.assertEqual(json.loads(f.read())['order']['candidate'], [candidate.pk, 'candidate'])
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, capacity=3, now=100)
+        self.assertEqual([bucket.consume(100) for _ in range(4)], [True, True, True, False])
+        # Half a second buys one token at two a second
+        self.assertFalse(bucket.consume(100.4))
+        self.assertTrue(bucket.consume(100.5))
+        self.assertFalse(bucket.consume(100.5))
+        # Never more than the burst, however long it was idle
+        self.assertEqual([bucket.consume(1000) for _ in range(4)], [True, True, True, False])
+
+    def test_local_limiter_prunes_full_buckets(self):
+        limiter = LocalRateLimiter({'send': (1, 2)})
+        limiter.prune_at = 2
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100):
+            self.assertTrue(async_to_sync(limiter.allow)(1, 'send'))
+            self.assertTrue(async_to_sync(limiter.allow)(2, 'send'))
+            self.assertTrue(async_to_sync(limiter.allow)(2, 'send'))
+            self.assertTrue(async_to_sync(limiter.allow)(3, 'typing'))
+            self.assertEqual(set(limiter.buckets), {(1, 'send'), (2, 'send')})
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=101):
+            # User 1 is full again and goes, user 2 still has one token to get back
+            self.assertTrue(async_to_sync(limiter.allow)(3, 'send'))
+        self.assertEqual(set(limiter.buckets), {(2, 'send'), (3, 'send')})
+        self.assertEqual(limiter.buckets[2, 'send'].tokens, 1)
+
+
+@override_settings(CHAT_RATE_LIMITS={'send': (1, 3)})
+class RateLimitTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('owner', password='a')
+        self.chat = Order.objects.create(user=owner, title='order').get_chat(User.objects.create_user('candidate'))
+        self.client.login(username='owner', password='a')
+        ratelimit._limiter = None
+        self.addCleanup(setattr, ratelimit, '_limiter', None)
+
+    async def flood(self):
+        communicator = websocket(self.client, '/chat/%s/' % self.chat.pk)
+        await communicator.connect()
+        while not (await communicator.receive_json_from()).get('join'):
+            pass
+        replies = []
+        for n in range(4):
+            await communicator.send_json_to({'command': 'send', 'chat': self.chat.pk, 'message': str(n)})
+            replies.append(await communicator.receive_json_from())
+        await communicator.disconnect()
+        return replies
+
+    def test_send_past_the_burst_is_rejected(self):
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100):
+            replies = async_to_sync(self.flood)()
+        self.assertEqual([reply.get('message') for reply in replies[:3]], ['0', '1', '2'])
+        self.assertEqual(replies[3], {'error': 'RATE_LIMITED'})
+        self.assertEqual(list(Message.objects.values_list('message', flat=True)), ['0', '1', '2'])
+
+
+class PurgeTests(TestCase):
+    def test_purge_keeps_recent_failed_and_keyed_jobs(self):
+        old = timezone.now() - timedelta(days=2)
+        for status, key, finished in [
+            (JobStatuses.DONE, None, old),
+            (JobStatuses.DONE, None, timezone.now()),
+            (JobStatuses.DONE, 'chat-1-rejected', old),
+            (JobStatuses.FAILED, None, old),
+        ]:
+            Job.objects.create(name='chat_message', status=status, key=key, finished=finished)
+        call_command('runjobs', once=True, purge_after=86400, stderr=mock.Mock())
+        self.assertEqual(Job.objects.count(), 3)
+        self.assertFalse(Job.objects.filter(key__isnull=True, status=JobStatuses.DONE, finished=old).exists())
+
+
+class JumpHashTests(SimpleTestCase):
+    def test_reference_vectors(self):
+        # From the reference implementations of the paper
+        for key, buckets, bucket in [(1, 1, 0), (42, 57, 43), (0xDEAD10CC, 1, 0), (0xDEAD10CC, 666, 361), (256, 1024, 520)]:
+            self.assertEqual(jump_hash(key, buckets), bucket)
+
+    def test_adding_a_bucket_moves_one_in_n(self):
+        rng = random.Random(0)
+        keys = [rng.getrandbits(64) for _ in range(20000)]
+        for buckets in (1, 2, 3, 4, 7, 10):
+            moved = [key for key in keys if jump_hash(key, buckets) != jump_hash(key, buckets + 1)]
+            # Only to the new bucket, and about 1/(n+1) of them
+            self.assertEqual({jump_hash(key, buckets + 1) for key in moved}, {buckets})
+            self.assertAlmostEqual(len(moved) / len(keys), 1 / (buckets + 1), delta=.015)
+
+    def test_layer_keeps_groups_when_a_host_is_added(self):
+        hosts = [("redis%d" % n, 6379) for n in range(4)]
+        three, four = ShardedChannelLayer(hosts=hosts[:3]), ShardedChannelLayer(hosts=hosts)
+        groups = ["chat-%d" % n for n in range(5000)]
+        moved = [group for group in groups if three.consistent_hash(group) != four.consistent_hash(group)]
+        self.assertEqual({four.consistent_hash(group) for group in moved}, {3})
+        self.assertAlmostEqual(len(moved) / len(groups), 1 / 4, delta=.03)
+
+
+@skipUnless(shutil.which("redis-server"), "needs redis-server on PATH")
+class ShardedLayerRedisTests(SimpleTestCase):
+    def test_groups_on_several_redis_servers(self):
+        with redis_servers(3) as hosts:
+            async_to_sync(self.exchange)(hosts)
+            # Every shard got some of the groups
+            for host, port in hosts:
+                client = redis.Redis(host=host, port=port)
+                self.assertTrue(client.keys("asgi:group:*"))
+                client.close()
+
+    async def exchange(self, hosts):
+        layer = ShardedChannelLayer(hosts=hosts)
+        channels = {}
+        for n in range(30):
+            group = "chat-%d" % n
+            channels[group] = await layer.new_channel()
+            await layer.group_add(group, channels[group])
+        for group in channels:
+            await layer.group_send(group, {"type": "chat.notice", "group": group})
+        for group, channel in channels.items():
+            self.assertEqual((await layer.receive(channel))["group"], group)
+        await layer.close_pools()
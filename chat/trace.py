@@ -0,0 +1,60 @@
+"""
+Records the websocket commands clients send, for "manage.py replaytrace".
+
+Turned on by the CHAT_TRACE_FILE setting. Every line of the file is a JSON
+object: connection events ("connect", "receive", "disconnect") with the
+time since recording started, and "chat" records describing every chat
+that was joined so the replay can recreate them.
+"""
+
+import json
+import os
+import time
+
+from django.conf import settings
+
+
+_file = None
+_start = None
+_chats = set()
+
+
+def _write(line):
+    global _file
+    if _file is None:
+        _file = open(settings.CHAT_TRACE_FILE.format(pid=os.getpid()), "a", buffering=1)
+    _file.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+def record(conn, event, **data):
+    global _start
+    if not settings.CHAT_TRACE_FILE:
+        return
+    now = time.monotonic()
+    if _start is None:
+        _start = now
+    _write(dict(t=round(now - _start, 6), conn=conn, event=event, **data))
+
+
+def record_chat(chat):
+    if not settings.CHAT_TRACE_FILE or chat.id in _chats:
+        return
+    _chats.add(chat.id)
+    order = chat.order
+    _write({
+        "event": "chat",
+        "id": chat.id,
+        "rejected": chat.rejected,
+        "candidate": [chat.candidate_id, chat.candidate.username],
+        "order": {
+            "id": order.id,
+            "title": order.title,
+            "status": order.status,
+            "user": [order.user_id, order.user.username],
+            # Cached chats don't load the order's candidate (see CHAT_FIELDS), they
+            # are either this chat's candidate or get a made up name in the replay
+            "candidate": order.candidate_id and [
+                order.candidate_id, chat.candidate.username if order.candidate_id == chat.candidate_id else None,
+            ],
+        },
+    })
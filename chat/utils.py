@@ -1,9 +1,19 @@
 from channels.db import database_sync_to_async
 
+from .cache import aget_cached, chat_key
 from .exceptions import ClientError
 from .models import Chat, Order
 
 
+CHAT_RELATED = ('order__user', 'candidate')
+# What is_writable, users() and chat_info read. Chats are cached in the shared
+# cache, so the rest of the user rows (password hashes and all) stay out.
+CHAT_FIELDS = (
+    'rejected', 'timestamp', 'order__title', 'order__status', 'order__candidate',
+    'order__user__username', 'order__user__last_login', 'candidate__username', 'candidate__last_login',
+)
+
+
 @database_sync_to_async
 def get_chat_for_order_or_error(order_id, user):
     # Check if the user is logged in
@@ -24,11 +34,15 @@ async def get_chat_or_error(chat_id, user):
     if not user.is_authenticated:
         raise ClientError("USER_HAS_TO_LOGIN")
     # Find the room they requested (by ID)
-    try:
-        chat = await Chat.objects.select_related('order', 'order__candidate', 'order__user', 'candidate').aget(pk=chat_id)
-    except Chat.DoesNotExist:
-        raise ClientError("CHAT_INVALID")
+    chat = await aget_cached(chat_key(chat_id), lambda: load_chat_or_error(chat_id))
     # Check permissions
     if chat.order.candidate_id and chat.order.candidate_id != user.id:
         raise ClientError("CHAT_STOPPED")
     return chat
+
+
+async def load_chat_or_error(chat_id):
+    try:
+        return await Chat.objects.select_related(*CHAT_RELATED).only(*CHAT_FIELDS).aget(pk=chat_id)
+    except Chat.DoesNotExist:
+        raise ClientError("CHAT_INVALID")
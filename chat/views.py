@@ -1,5 +1,6 @@
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Max, Q
 from django.views.generic import TemplateView, DetailView
 from rest_framework.serializers import ModelSerializer
 from rest_framework.viewsets import ModelViewSet
@@ -7,10 +8,37 @@ from django_filters.rest_framework.backends import DjangoFilterBackend
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from django.http import Http404
 from django.shortcuts import HttpResponseRedirect
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework.permissions import IsAuthenticated
 
-from chat.models import Order, Message, OrderStatuses, Chat
+from chat.cache import chat_key, get_cached, get_version, listing_etag, order_key
+from chat.jobs import enqueue
+from chat.models import Order, Message, OrderStatuses, Chat, ReadState
+from chat.utils import CHAT_FIELDS, CHAT_RELATED
+
+
+def orders_version(request, *args, **kwargs):
+    return get_version('orders')
+
+
+def orders_etag(request, *args, **kwargs):
+    return listing_etag(request, orders_version(request))
+
+
+def messages_version(request, *args, **kwargs):
+    # Versions are bumped under the integer id, so "05" must read the one of 5.
+    # Anything else falls back to the version of all messages.
+    try:
+        return get_version('messages', int(request.GET['chat']))
+    except (KeyError, ValueError):
+        return get_version('messages')
+
+
+def messages_etag(request, *args, **kwargs):
+    return listing_etag(request, messages_version(request))
 
 
 class OrderSerializer(ModelSerializer):
@@ -24,9 +52,20 @@ class OrderViewSet(ModelViewSet):
     permission_classes = [IsAuthenticated]
     pagination_class = None
 
+    @method_decorator(condition(etag_func=orders_etag))
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
     @action(detail=True)
     def start_chat(self, request, pk=None):
-        obj = self.get_object()
+        # Cached under the integer id that invalidate uses, and checked like
+        # get_object would on every request, not only when it is loaded
+        try:
+            pk = int(pk)
+        except ValueError:
+            raise Http404
+        obj = get_cached(order_key(pk), self.get_object)
+        self.check_object_permissions(request, obj)
         if obj.status != OrderStatuses.PUBLISHED.value and (obj.status == OrderStatuses.STARTED.value and self.request.user not in (obj.user, obj.candidate)) and obj.user != self.request.user:
             raise PermissionDenied
         return HttpResponseRedirect(f'/chats/{obj.get_chat(self.request.user).pk}/')
@@ -47,26 +86,48 @@ class MessageViewSet(ModelViewSet):
     pagination_class = None
 
     def get_queryset(self):
-        return Message.objects.filter(Q(chat__user=self.request.user) | Q(chat__order__user=self.request.user))
+        return Message.objects.filter(Q(chat__candidate=self.request.user) | Q(chat__order__user=self.request.user))
+
+    @method_decorator(condition(etag_func=messages_etag))
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    def _mark_read(self, qs):
+        # Moves the user's read watermarks like the "read" websocket command,
+        # which only marks the messages after the old watermark
+        last_read = qs.order_by().values_list('chat_id').annotate(last=Max('pk'))
+        changed, updated = [], 0
+        with transaction.atomic():
+            for chat_id, last in last_read:
+                states, marked = ReadState.advance(chat_id, {self.request.user.id: (last, last)})
+                changed += states
+                updated += marked
+            if changed:
+                enqueue('send_receipts', [state.pk for state in changed])
+        return updated
 
     @action(detail=True)
     def mark_read(self, request, pk=None):
         qs = self.filter_queryset(self.get_queryset())
         if pk:
             qs = qs.filter(pk=pk)
-        return Response({'updated': qs.update(unread=False)})
+        return Response({'updated': self._mark_read(qs)})
 
     @action(detail=False)
     def mark_read_all(self, request):
         qs = self.filter_queryset(self.get_queryset())
-        return Response({'updated': qs.update(unread=False)})
+        return Response({'updated': self._mark_read(qs)})
 
 
 class IndexView(LoginRequiredMixin, TemplateView):
     template_name = 'index.html'
 
     def get_context_data(self, **kwargs):
-        return {'orders': Order.objects.all(), 'chats': Chat.objects.filter(Q(candidate=self.request.user) | Q(order__user=self.request.user))}
+        chats = Chat.objects.filter(Q(candidate=self.request.user) | Q(order__user=self.request.user))
+        return {
+            'orders': Order.objects.all(),
+            'chats': chats.select_related('order', 'last_message__user').order_by('-last_activity'),
+        }
 
 
 class ChatView(LoginRequiredMixin, DetailView):
@@ -74,3 +135,13 @@ class ChatView(LoginRequiredMixin, DetailView):
 
     def get_queryset(self):
         return Chat.objects.filter(Q(candidate=self.request.user) | Q(order__user=self.request.user))
+
+    def get_object(self, queryset=None):
+        pk = self.kwargs['pk']
+        try:
+            chat = get_cached(chat_key(pk), lambda: Chat.objects.select_related(*CHAT_RELATED).only(*CHAT_FIELDS).get(pk=pk))
+        except Chat.DoesNotExist:
+            raise Http404
+        if self.request.user.pk not in (chat.candidate_id, chat.order.user_id):
+            raise Http404
+        return chat
@@ -0,0 +1,138 @@
+"""
+Worker side of the runworkers launcher: keeps track of the websockets held
+by this process, reports health to the shared cache and drains the
+connections when the launcher asks for it (SIGUSR1).
+"""
+
+import asyncio
+import logging
+import os
+import random
+import signal
+import socket
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = os.environ.get("CHAT_WORKER_ID")
+DRAIN_TIMEOUT = float(os.environ.get("CHAT_DRAIN_TIMEOUT", 30))
+HEALTH_INTERVAL = 10
+
+# Consumers currently connected to this process
+connections = weakref.WeakSet()
+draining = False
+# Set by multichat.asgi to the time it started loading
+started = time.time()
+first_accepted = None
+
+
+def health_key(worker_id, host=None):
+    return "worker-%s-%s" % (host or socket.gethostname(), worker_id)
+
+
+def health():
+    return {
+        "pid": os.getpid(),
+        "connections": len(connections),
+        "draining": draining,
+        "started": started,
+        "first_accepted": first_accepted,
+        "updated": time.time(),
+    }
+
+
+def accepted(consumer):
+    global first_accepted
+    connections.add(consumer)
+    if first_accepted is None:
+        first_accepted = time.time()
+        logger.info("First connection accepted %.3fs after startup", first_accepted - started)
+
+
+async def report_health():
+    await cache.aset(health_key(WORKER_ID), health(), HEALTH_INTERVAL * 3)
+
+
+async def try_report_health():
+    try:
+        await report_health()
+    except Exception:
+        logger.exception("Could not report worker health")
+
+
+async def heartbeat():
+    while True:
+        await try_report_health()
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+
+async def flush():
+    """
+    Writes out what is buffered in memory before the process exits: read
+    receipts and last_login times. The last_login job may not get to run
+    before the exit, runjobs picks it up then.
+    """
+    from . import jobs, receipts
+    for name, flush_buffer in (
+        ("receipts", receipts.flush_all),
+        ("last logins", sync_to_async(jobs.flush_last_logins)),
+    ):
+        try:
+            await flush_buffer()
+        except Exception:
+            logger.exception("Could not flush %s", name)
+
+
+async def drain():
+    """
+    Stops accepting connections, then closes the existing ones at random
+    points over DRAIN_TIMEOUT so their reconnects spread over the other
+    workers instead of arriving all at once, flushes what is buffered in
+    memory and stops the server.
+    """
+    global draining
+    if draining:
+        return
+    draining = True
+    from twisted.internet import reactor, tcp
+    try:
+        for reader in reactor.getReaders():
+            if isinstance(reader, tcp.Port):
+                reader.stopListening()
+        consumers = list(connections)
+        logger.info("Worker %s draining %d connections", WORKER_ID, len(consumers))
+        await try_report_health()
+
+        async def close(consumer):
+            await asyncio.sleep(random.uniform(0, DRAIN_TIMEOUT))
+            await consumer.drain()
+
+        await asyncio.gather(*(close(consumer) for consumer in consumers), return_exceptions=True)
+        # Let disconnect() leave the groups before the applications are killed
+        deadline = time.monotonic() + 5
+        while connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await flush()
+        await try_report_health()
+    finally:
+        reactor.stop()
+
+
+def install():
+    """
+    Hooks the worker into the Daphne server it runs in. Only called when
+    started by runworkers.
+    """
+    from twisted.internet import reactor
+
+    def running():
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(drain()))
+        asyncio.ensure_future(heartbeat())
+
+    reactor.callWhenRunning(running)
@@ -1,28 +1,62 @@
 """
 ASGI entrypoint. Configures Django and then runs the application
 defined in the ASGI_APPLICATION setting.
+
+With CHAT_WORKER_MODE=websocket only websockets are served and the HTTP
+side (middleware, admin, DRF) is never loaded. Otherwise the HTTP app is
+built on the first HTTP request rather than at startup.
 """
 
+import logging
 import os
-from django.urls import path
-from channels.routing import ProtocolTypeRouter
-from django.core.asgi import get_asgi_application
+import time
+
+started = time.time()
+
+import django
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
-from django.core.asgi import get_asgi_application
-import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "multichat.settings")
 django.setup()
-from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+from chat import workers
+from chat.middleware import UserRecordAuthMiddlewareStack
 from multichat.routing import websocket_urlpatterns
-application = ProtocolTypeRouter(
-    {
-        "http": get_asgi_application(),
-        "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+
+logger = logging.getLogger(__name__)
+
+
+class LazyApplication:
+    """
+    ASGI application built by `factory` when it gets its first connection.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.application = None
+
+    async def __call__(self, scope, receive, send):
+        if self.application is None:
+            self.application = self.factory()
+        return await self.application(scope, receive, send)
+
+
+protocols = {
+    "websocket": AllowedHostsOriginValidator(
+        UserRecordAuthMiddlewareStack(
             URLRouter(websocket_urlpatterns)
         )
     ),
-    }
-)
+}
+if settings.WORKER_MODE != "websocket":
+    from django.core.asgi import get_asgi_application
+    protocols["http"] = LazyApplication(get_asgi_application)
+application = ProtocolTypeRouter(protocols)
+
+# Started by "manage.py runworkers", hook into its drain and health reporting
+if os.environ.get("CHAT_WORKER_ID"):
+    workers.install()
+
+workers.started = started
+logger.info("ASGI application (%s mode) loaded in %.3fs", settings.WORKER_MODE, time.time() - started)
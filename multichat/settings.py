@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/dev/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -19,22 +20,87 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 ##### Channels-specific settings
 
 ASGI_APPLICATION = 'multichat.asgi.application'
+# "websocket" starts workers that only serve websockets and don't load the
+# HTTP side at all (see multichat/asgi.py)
+WORKER_MODE = os.environ.get('CHAT_WORKER_MODE', 'all')
 redis_host = os.environ.get('REDIS_HOST', 'localhost')
+# Comma separated "host:port" list of channel layer shards, e.g.
+# REDIS_HOSTS=redis1:6379,redis2:6379. Order matters and must be the same on all nodes.
+redis_hosts = [
+    (host, int(port or 6379))
+    for host, _, port in (h.strip().partition(':') for h in os.environ.get('REDIS_HOSTS', redis_host).split(','))
+]
 
 # Channel layer definitions
 # http://channels.readthedocs.io/en/latest/topics/channel_layers.html
 CHANNEL_LAYERS = {
     "default": {
-        # This example app uses the Redis channel layer implementation channels_redis
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # channels_redis' Redis layer, with groups consistently hashed over the shards
+        "BACKEND": "chat.layers.ShardedChannelLayer",
         "CONFIG": {
-            "hosts": [(redis_host, 6379)],
+            "hosts": redis_hosts,
         },
     },
 }
 
 # ASGI_APPLICATION should be set to your outermost router
 
+# Two-level cache: a short-lived per-process "local" cache in front of the
+# shared Redis one. Other workers' local copies aren't invalidated, so the
+# local TIMEOUT bounds how stale they can get.
+# https://docs.djangoproject.com/en/dev/topics/cache/
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://%s:6379/1" % redis_host,
+        "TIMEOUT": 300,
+    },
+    "local": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "TIMEOUT": 2,
+    },
+}
+
+# Per user token buckets for websocket commands: command -> (tokens per second, burst).
+# Clients send "typing" on every keypress, hence its large bucket.
+CHAT_RATE_LIMITS = {
+    "send": (1, 10),
+    "typing": (10, 30),
+    "ping": (1, 5),
+    "join": (1, 10),
+    "leave": (1, 10),
+    "ack": (5, 20),
+    "read": (5, 20),
+}
+# "local" keeps the buckets in each worker, "redis" shares them between all nodes
+CHAT_RATE_LIMIT_BACKEND = os.environ.get('CHAT_RATE_LIMIT_BACKEND', 'local')
+CHAT_RATE_LIMIT_REDIS = "redis://%s:6379/2" % redis_host
+
+# Background jobs (chat.jobs): threads per process running them (0 runs them
+# inline after commit), attempts before a job is given up on, and seconds after
+# which a running job is considered lost
+CHAT_JOB_THREADS = 2
+CHAT_JOB_MAX_ATTEMPTS = 5
+CHAT_JOB_STALLED_AFTER = 300
+# Seconds between batched last_login writes from websocket pings
+CHAT_LAST_LOGIN_INTERVAL = 10
+# Receipts are stored and sent to a chat at most once per this many seconds
+CHAT_RECEIPT_INTERVAL = 1
+
+# Record websocket commands to this file for "manage.py replaytrace", "{pid}"
+# is replaced with the process id so every worker gets its own file
+CHAT_TRACE_FILE = os.environ.get('CHAT_TRACE_FILE')
+
+# Tests don't get a Redis server, use process-local stand-ins instead. Jobs
+# run inline, the in-memory channel layer can't be used from other threads.
+if sys.argv[1:2] == ['test']:
+    CACHES["default"] = {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "shared",
+    }
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    CHAT_JOB_THREADS = 0
+
 
 
 ##### Normal Django settings
@@ -56,6 +122,11 @@ INSTALLED_APPS = [
     'rest_framework',
     'chat',
 ]
+if WORKER_MODE == 'websocket':
+    INSTALLED_APPS = [
+        app for app in INSTALLED_APPS
+        if app not in ('django.contrib.admin', 'django.contrib.messages', 'django.contrib.staticfiles', 'rest_framework')
+    ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -94,10 +165,12 @@ WSGI_APPLICATION = 'multichat.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/dev/ref/settings/#databases
+# CHAT_DATABASE points workers elsewhere, "manage.py benchstartup" starts
+# them on its test database
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'NAME': os.environ.get('CHAT_DATABASE', os.path.join(BASE_DIR, 'db.sqlite3')),
     }
 }
 